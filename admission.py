@@ -0,0 +1,92 @@
+"""Load shedding: answer 503 right away instead of serving requests late
+"""
+# An overloaded dyno queues requests in the router and in gunicorn until
+# clients give up, then does the work anyway. Every request is put in a
+# class, each class has a queue wait target and a cap on the threads it
+# may hold in a worker:
+#
+# - queue wait is how long the request waited before a thread picked it
+#   up, from the X-Request-Start header heroku's router sets. A class is
+#   shed once its requests keep waiting longer than the target for
+#   SHED_AFTER seconds ( like CoDel, a short burst is absorbed, a standing
+#   queue is not ). The first request under the target ends it.
+# - a class at its cap is turned away, writes can never hold every thread
+#   of a worker, there's always one left for reads. It isn't made to wait
+#   for one of its class' threads, the waiting would take up a thread too.
+#
+# Reads are cheap and mostly cached, so they get the most room, scrypt
+# endpoints the least. State is per worker, like the threads it guards.
+from math import ceil
+from threading import Lock
+from time import time
+
+import metrics
+from constants import WEB_THREADS
+from rate_limit import ROUTES
+
+# class -> (threads it may hold, queue wait target in seconds)
+CLASSES = {
+    "read": (WEB_THREADS, 5.0),
+    "write": (max(WEB_THREADS - 1, 1), 2.0),
+    "auth": (max(WEB_THREADS // 2, 1), 1.0),
+}
+SHED_AFTER = 1.0
+
+_lock = Lock()
+_in_flight = dict.fromkeys(CLASSES, 0)
+# class -> since when its requests have waited longer than the target
+_over_target_since = {}
+
+
+def request_class(request) -> str:
+    if ROUTES.get(request.endpoint) == "auth":
+        return "auth"
+    return "read" if request.method in ("GET", "HEAD", "OPTIONS") else "write"
+
+
+def queue_wait(request) -> float:
+    """Seconds since the router got the request, 0 without the header"""
+    start = request.headers.get("x-request-start", "")
+    try:
+        start = float(start[2:] if start.startswith("t=") else start)
+    except ValueError:
+        return 0.0
+    # heroku sends milliseconds, nginx's $msec is seconds
+    if start > 1e11:
+        start /= 1000
+    return max(time() - start, 0.0)
+
+
+def admit(request):
+    """Count the request in, or say how long to wait before retrying
+
+    Returns:
+        tuple: (class, 0) if admitted, `release(class)` once it's done,
+            or (class, seconds) if it was shed
+    """
+    klass = request_class(request)
+    limit, target = CLASSES[klass]
+    waited = queue_wait(request)
+    now = time()
+    metrics.observe(f"queue_wait_{klass}_seconds", waited)
+    with _lock:
+        if waited <= target:
+            _over_target_since.pop(klass, None)
+            shed = False
+        else:
+            since = _over_target_since.setdefault(klass, now)
+            shed = now - since >= SHED_AFTER
+        shed = shed or _in_flight[klass] >= limit
+        if not shed:
+            _in_flight[klass] += 1
+            metrics.set_gauge(f"in_flight_{klass}", _in_flight[klass])
+            return klass, 0
+    metrics.inc(f"shed_{klass}")
+    # by then the queue has had as long to drain as this request waited
+    return klass, max(ceil(waited), 1)
+
+
+def release(klass: str):
+    with _lock:
+        _in_flight[klass] -= 1
+        metrics.set_gauge(f"in_flight_{klass}", _in_flight[klass])
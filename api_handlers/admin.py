@@ -1,9 +1,33 @@
-from app_init import TeamTable, UserTable
+from csv import DictReader
+from hmac import compare_digest
+from json import loads
+from multiprocessing import cpu_count, get_context
+from time import time
+
+from flask import Response
+from flask import request as flask_request
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import lazyload
+
+import config_cache
+import metrics
+from app_init import EventConfig, TeamTable, UserTable, WorkerMetrics, db
 from auth_token import require_jwt
+from constants import EVENT_NAMES, METRICS_TOKEN
+from danger import generate_password_hash
+from jobs import enqueue
 from util import AppException, ParsedRequest
 
-from .common import get_clan_by_id, get_config, get_user_by_id, query_all, save_to_db
+from .common import (
+    get_clan_by_id,
+    get_config,
+    get_user_by_id,
+    query_all,
+    reader,
+    save_to_db,
+)
 from .cred_manager import CredManager
+from .data_util import init_user_event_dict
 
 
 def require_admin(func):
@@ -21,10 +45,7 @@ def require_admin(func):
 SUCCESS = {"success": True}
 
 
-@require_admin
-def score_team(request: ParsedRequest, team, creds=CredManager):
-    json = request.json
-    team_data = get_clan_by_id(team)
+def _apply_score(team_data: TeamTable, json: dict):
     score = int(json["score"])
     if not 0 <= score <= 20:
         raise AppException("Invalid value of score")
@@ -36,6 +57,227 @@ def score_team(request: ParsedRequest, team, creds=CredManager):
     if score > 5 and get_config(team_data.team_event).number_of_rounds < round_num:
         team_data.current_round += 1
     team_data.score.append(score)
+
+
+@require_admin
+def score_team(request: ParsedRequest, team, creds=CredManager):
+    team_data = get_clan_by_id(team)
+    _apply_score(team_data, request.json)
+    save_to_db()
+    return SUCCESS
+
+
+MAX_BULK_SCORES = 1000
+
+
+@require_admin
+def bulk_score(request: ParsedRequest, creds=CredManager):
+    """Score many teams in one transaction
+
+    Body: `{"scores": [{"team": str, "round": int, "score": int}, ...]}`
+    Teams are loaded with one query, every entry is validated like
+    `score_team` and gets its own result, the valid ones are written with a
+    single commit.
+    """
+    entries = request.json.get("scores")
+    if not isinstance(entries, list) or not entries:
+        raise AppException("No scores provided")
+    if len(entries) > MAX_BULK_SCORES:
+        raise AppException(f"Can only score {MAX_BULK_SCORES} teams at once")
+
+    names = {
+        str(x.get("team")).lower() for x in entries if isinstance(x, dict)
+    }
+    # lock the rows so a parallel request can't score the same round twice
+    teams = {
+        x.team_name: x
+        for x in TeamTable.query.filter(TeamTable.team_name.in_(names))
+        .options(lazyload(TeamTable.memberships))
+        .with_for_update(of=TeamTable)
+    }
+    results = []
+    scored = set()
+    for entry in entries:
+        if not isinstance(entry, dict):
+            results.append({"team": None, "success": False, "error": "Invalid data"})
+            continue
+        team = str(entry.get("team")).lower()
+        try:
+            team_data = teams.get(team)
+            if team_data is None:
+                raise AppException("Clan does not exist")
+            if team in scored:
+                raise AppException("Team is scored twice in this request")
+            _apply_score(team_data, entry)
+            scored.add(team)
+            results.append({"team": team, "success": True})
+        except AppException as e:
+            results.append({"team": team, "success": False, "error": f"{e}"})
+        except (KeyError, TypeError, ValueError):
+            results.append({"team": team, "success": False, "error": "Invalid data"})
+
+    save_to_db()
+    return {"scored": len(scored), "results": results}
+
+
+# a scrypt hash takes ~0.2s of one core, this many still fit in the router's
+# 30s timeout on a single core. Bigger imports are sent in several parts
+MAX_IMPORT_ROWS = 100
+_IMPORT_FIELDS = ("user", "name", "email", "password", "school")
+_INSERT_CHUNK = 1000
+
+
+def _parse_import(body: str, is_csv: bool) -> list:
+    if is_csv:
+        return list(DictReader(body.splitlines()))
+    rows = []
+    for line in body.splitlines():
+        line = line.strip()
+        if line:
+            try:
+                rows.append(loads(line))
+            except ValueError:
+                rows.append(None)
+    return rows
+
+
+def _validate_import_row(row, seen_users: set, seen_emails: set) -> dict:
+    if not isinstance(row, dict):
+        raise AppException("Invalid data")
+    user, name, email, password, school = (
+        row.get(x) or None for x in _IMPORT_FIELDS
+    )
+    if not all(isinstance(x, str) for x in (user, name, email, password)):
+        raise AppException("Invalid Data")
+    if school is not None and not isinstance(school, str):
+        raise AppException("Invalid Data")
+    UserTable.validate_new_user(user, name, email, password)
+    if len(name) > 30 or (school and len(school) > 30):
+        raise AppException("Name and school cannot be longer than 30 characters")
+    user = user.lower()
+    if user in seen_users or email.lower() in seen_emails:
+        raise AppException("Duplicate user in this file")
+    seen_users.add(user)
+    seen_emails.add(email.lower())
+    return {
+        "user": user,
+        "name": name,
+        "email": email,
+        "school": school,
+        "password": password,
+    }
+
+
+def _hash_passwords(passwords: list) -> list:
+    # scrypt is the slow part, spread it over every core. `spawn` because
+    # forking a threaded gunicorn worker can copy locks held by other threads
+    processes = min(cpu_count(), max(len(passwords) // 50, 1))
+    if processes == 1:
+        return [generate_password_hash(x) for x in passwords]
+    with get_context("spawn").Pool(processes) as pool:
+        return pool.map(
+            generate_password_hash,
+            passwords,
+            chunksize=max(len(passwords) // (processes * 4), 1),
+        )
+
+
+@require_admin
+def import_users(request: ParsedRequest, creds=CredManager):
+    """Create accounts in bulk from a CSV ( header: user,name,email,password,school )
+    or NDJSON body. Every row is validated like a registration, rows that fail
+    or clash with an existing account are reported back and skipped.
+    """
+    content_type = flask_request.content_type or ""
+    body = flask_request.get_data(as_text=True)
+    rows = _parse_import(body, "csv" in content_type)
+    if not rows:
+        raise AppException("No users provided")
+    if len(rows) > MAX_IMPORT_ROWS:
+        raise AppException(f"Can only import {MAX_IMPORT_ROWS} users at once")
+
+    errors = []
+    valid = []
+    seen_users, seen_emails = set(), set()
+    for line, row in enumerate(rows, 1):
+        try:
+            valid.append(_validate_import_row(row, seen_users, seen_emails))
+        except AppException as e:
+            user = row.get("user") if isinstance(row, dict) else None
+            errors.append({"line": line, "user": user, "error": f"{e}"})
+
+    hashes = _hash_passwords([x.pop("password") for x in valid])
+    now = int(time())
+    for row, password_hash in zip(valid, hashes):
+        row["password_hash"] = password_hash
+        row["team_data"] = init_user_event_dict()
+        row["created_at"] = now
+        row["is_admin"] = False
+        row["has_verified_email"] = False
+
+    # multi-row INSERTs, anything that hits a unique constraint
+    # ( user, email ) is left out of RETURNING and reported as existing
+    created = set()
+    table = UserTable.__table__
+    for i in range(0, len(valid), _INSERT_CHUNK):
+        stmt = (
+            insert(table)
+            .values(valid[i : i + _INSERT_CHUNK])
+            .on_conflict_do_nothing()
+            .returning(table.c.user)
+        )
+        created.update(x[0] for x in db.session.execute(stmt))
+    save_to_db()
+
+    existing = [x["user"] for x in valid if x["user"] not in created]
+    errors.extend({"user": x, "error": "User exists"} for x in existing)
+    return {"created": len(created), "errors": errors}
+
+
+@require_admin
+def update_event_config(request: ParsedRequest, event, creds=CredManager):
+    """Change an event's config without restarting the dynos
+
+    Body: `{"number_of_rounds": int, "config": {...}}`, both optional, keys in
+    `config` are merged into the stored one ( `null` removes a key ).
+    Every worker reloads its copy once this commits.
+    """
+    if event not in EVENT_NAMES:
+        raise AppException("Event does not exist")
+    json = request.json
+    config_data = EventConfig.query.filter_by(event_name=event).with_for_update().first()
+    if config_data is None:
+        config_data = EventConfig(event, 0, {})
+        db.session.add(config_data)
+
+    try:
+        if "number_of_rounds" in json:
+            config_data.number_of_rounds = int(json["number_of_rounds"])
+        changes = json.get("config") or {}
+        if not isinstance(changes, dict):
+            raise TypeError
+        if "max_players" in changes and changes["max_players"] is not None:
+            if int(changes["max_players"]) < 1:
+                raise ValueError
+    except (TypeError, ValueError):
+        raise AppException("Invalid data")
+
+    config = dict(config_data.config or {})
+    config.update(changes)
+    config_data.config = {k: v for k, v in config.items() if v is not None}
+    config_cache.notify(event)
+    save_to_db()
+    return {
+        "event_name": event,
+        "number_of_rounds": config_data.number_of_rounds,
+        "config": config_data.config,
+    }
+
+
+@require_admin
+def reconcile_discord_roles(request: ParsedRequest, creds=CredManager):
+    # runs in worker.py, see tasks.reconcile_roles
+    enqueue("reconcile_roles", {}, dedupe_key="reconcile_roles")
     save_to_db()
     return SUCCESS
 
@@ -77,9 +319,40 @@ def delete_team(request: ParsedRequest, team, creds=CredManager):
 
 @require_admin
 def get_secure_team_data(request: ParsedRequest, creds=CredManager):
-    return {"clans": query_all(TeamTable)}
+    return {"clans": query_all(TeamTable, reader(creds.user))}
 
 
 @require_admin
 def get_secure_user_data(request: ParsedRequest, creds=CredManager):
-    return {"users": query_all(UserTable)}
+    return {"users": query_all(UserTable, reader(creds.user))}
+
+
+@require_admin
+def get_metrics(request: ParsedRequest, creds=CredManager):
+    return metrics.snapshot()
+
+
+def _job_worker_snapshots() -> list:
+    rows = db.session.query(WorkerMetrics.snapshot).filter(
+        WorkerMetrics.updated_at > time() - WorkerMetrics.MAX_AGE
+    )
+    return [x[0] for x in rows]
+
+
+def _prometheus() -> str:
+    # this dyno's web workers and every job worker
+    return metrics.prometheus(metrics.collect() + _job_worker_snapshots())
+
+
+@require_admin
+def _all_workers_metrics(request: ParsedRequest, creds=CredManager):
+    return _prometheus()
+
+
+def get_prometheus_metrics(request: ParsedRequest):
+    authorization = request.headers.get("Authorization") or ""
+    if METRICS_TOKEN and compare_digest(authorization, f"Bearer {METRICS_TOKEN}"):
+        text = _prometheus()
+    else:
+        text = _all_workers_metrics(request)
+    return Response(text, content_type="text/plain; version=0.0.4")
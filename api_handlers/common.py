@@ -1,17 +1,49 @@
+from hashlib import blake2b as _blake2b
+from hmac import compare_digest as _compare_digest
+from time import time as _time
 from typing import Union
 
+from flask import after_this_request as _after_this_request
+from flask import g as _g
+from flask import request as _request
+from flask import has_request_context as _has_request_context
+from sqlalchemy import and_ as _and
+from sqlalchemy import bindparam as _bindparam
+from sqlalchemy import case as _case
+from sqlalchemy import cast as _cast
 from sqlalchemy import func as _func
+from sqlalchemy import literal as _literal
+from sqlalchemy import literal_column as _literal_column
+from sqlalchemy.dialects.postgresql import JSONB as _JSONB
+from sqlalchemy.ext import baked as _baked
+from sqlalchemy.orm.attributes import set_committed_value as _set_committed_value
 
-from app_init import EventConfig as _E
+import config_cache as _config_cache
 from app_init import TeamTable as _T
 from app_init import UserTable as _U
 from app_init import db as _db
+from app_init import replica_session as _replica
+from constants import IS_HEROKU, READ_YOUR_WRITES_SECONDS, SIGNING_KEY
 from util import AppException as _AppException
 from util import sanitize
 
 lower = _func.lower
 count = _func.count
 
+# The user/clan lookups below run on nearly every request. Baked queries
+# build the Query and compile its SQL once per process, later calls only bind
+# the parameter. (psycopg2 has no server-side prepared statements to add on top.)
+_bakery = _baked.bakery()
+
+_user_lookup = _bakery(lambda s: s.query(_U))
+_user_lookup += lambda q: q.filter(lower(_U.user) == lower(_bindparam("idx")))
+
+_clan_lookup = _bakery(lambda s: s.query(_T))
+_clan_lookup += lambda q: q.filter(lower(_T.team_name) == lower(_bindparam("idx")))
+
+_locked_clan_lookup = _clan_lookup.with_criteria(
+    lambda q: q.with_for_update(of=_T).populate_existing()
+)
 
 # pylint: disable=E1101
 def add_to_db(data, batch=False):
@@ -19,12 +51,80 @@ def add_to_db(data, batch=False):
     not batch and save_to_db()
 
 
-def query_all(table):
-    return table.query.all()
+def query_all(table, session=None):
+    return (session or _db.session).query(table).all()
 
 
 def save_to_db():
     _db.session.commit()
+    if _has_request_context():
+        mark_write(_g.get("user"))
+
+
+# The time of a user's last write travels with the client in a signed
+# cookie, the next request may well land on another dyno
+_WRITE_COOKIE = "qb-last-write"
+
+
+def _write_signature(user: str, at: str) -> str:
+    return _blake2b(f"{user}:{at}".encode(), key=SIGNING_KEY.encode()[:64], digest_size=16).hexdigest()
+
+
+def mark_write(user: str):
+    # the user's reads go to the primary for a while, until the replica caught up
+    if not user or _replica is None or not _has_request_context():
+        return
+    if "written_by" not in _g:
+
+        @_after_this_request
+        def set_write_cookie(response):
+            user, at = _g.written_by, f"{_time():.3f}"
+            response.set_cookie(
+                _WRITE_COOKIE,
+                f"{user}:{at}:{_write_signature(user, at)}",
+                max_age=READ_YOUR_WRITES_SECONDS,
+                httponly=True,
+                secure=IS_HEROKU,
+                samesite="None" if IS_HEROKU else "Lax",
+            )
+            return response
+
+    _g.written_by = user
+
+
+def _wrote_recently(user: str) -> bool:
+    try:
+        written_by, at, signature = _request.cookies[_WRITE_COOKIE].rsplit(":", 2)
+        at_time = float(at)
+    except (KeyError, ValueError):
+        return False
+    return (
+        written_by == user
+        and _time() - at_time < READ_YOUR_WRITES_SECONDS
+        and _compare_digest(signature, _write_signature(user, at))
+    )
+
+
+def reader(user: str = None):
+    """Session for read only handlers: the replica, unless `user` has written
+    something in the last READ_YOUR_WRITES_SECONDS.
+    Rows loaded from it must not be modified.
+
+    Args:
+        user (str, optional): the authenticated user, if any
+    """
+    if _replica is None or (user and _wrote_recently(user)):
+        return _db.session
+    return _replica
+
+
+def flush():
+    _db.session.flush()
+
+
+def savepoint():
+    # use as `with savepoint():`, rolls back only the block on an exception
+    return _db.session.begin_nested()
 
 
 def delete_from_db(d, batch=False):
@@ -33,24 +133,41 @@ def delete_from_db(d, batch=False):
         not batch and save_to_db()
 
 
-def get_user_by_id(idx: str) -> _U:
+def get_user_by_id(idx: str, session=None) -> _U:
     if not idx or sanitize(idx) != idx:
         return _assert_exists(None)
-    return _assert_exists(_U.query.filter(lower(_U.user) == lower(idx)).first())
+    # baked queries need the Session itself, not the scoped_session registry
+    session = (session or _db.session)()
+    return _assert_exists(_user_lookup(session).params(idx=idx).first())
 
 
-def get_clan_by_id(idx: str) -> _T:
+def get_users_by_id(ids: list) -> list:
+    # one query for many users, unknown or invalid names are left out
+    ids = [x for x in ids if x and sanitize(x) == x]
+    if not ids:
+        return []
+    return _U.query.filter(lower(_U.user).in_(ids)).all()
+
+
+def get_clan_by_id(idx: str, lock=False, session=None) -> _T:
+    """
+    Args:
+        idx (str): clan name
+        lock (bool, optional): SELECT ... FOR UPDATE, membership changes take
+            the clan row lock so checks like the member limit can't race.
+            The memberships are (re)loaded after the lock is held.
+        session (optional): see `reader`
+    """
     if not idx or sanitize(idx) != idx:
         return _assert_exists(None, "Clan")
-    return _assert_exists(
-        _T.query.filter(lower(_T.team_name) == lower(idx)).first(), "Clan"
-    )
+    lookup = _locked_clan_lookup if lock else _clan_lookup
+    session = (session or _db.session)()
+    return _assert_exists(lookup(session).params(idx=idx).first(), "Clan")
 
 
-def get_config(name: str) -> _E:
-    if not name or sanitize(name) != name:
-        return _assert_exists(None, "Event")
-    return _assert_exists(_E.query.filter_by(event_name=name).first(), "Event")
+def get_config(name: str):
+    # served from the worker's copy of the table, see config_cache
+    return _assert_exists(_config_cache.get(name), "Event")
 
 
 def get_table_size(table_attr):
@@ -63,20 +180,79 @@ def _assert_exists(user: _U, name="User"):
     return user
 
 
-def mutate(obj: dict, dictionary_key: str, internal_key: str, new_value):
-    """This function is needed to flag_modify the particular dictionary
-    in case we mutate an internal dict, we could use a oneliner flag_modified but 
-    it's more intuitive to explicitly do this and take advantage of `MutableDict`
+def atomic_update(row, values: dict, *conditions) -> bool:
+    """Apply `values` to `row` with a single conditional UPDATE, the database
+    evaluates `conditions` under the row lock so concurrent requests cannot
+    race between a check and the write.
+
+    The new column values are read back with RETURNING and written into the
+    identity map as committed state, so the row is not marked dirty and the
+    ORM never re-writes the whole column on flush.
+
+    Args:
+        row: a loaded model instance
+        values (dict): column name -> SQL expression
+        conditions: extra guard predicates
+
+    Returns:
+        bool: False if the guard rejected the update
+    """
+    table = type(row).__table__
+    pk = [getattr(row, c.key) for c in table.primary_key]
+    where = [c == v for c, v in zip(table.primary_key, pk)]
+    stmt = (
+        table.update()
+        .where(_and(*where, *conditions))
+        .values(**values)
+        .returning(*(table.c[k] for k in values))
+    )
+    result = _db.session.execute(stmt).first()
+    if result is None:
+        return False
+    for key, value in zip(values, result):
+        _set_committed_value(row, key, value)
+    return True
+
+
+def reload_on_access(row, *attrs):
+    # flush pending changes and expire `attrs` so the next access sees them,
+    # needed for viewonly relationships like UserTable.memberships
+    flush()
+    _db.session.expire(row, attrs)
+
+
+def as_jsonb(value):
+    return _cast(_literal(value, _JSONB), _JSONB)
+
+
+_EMPTY_OBJECT = _literal_column("'{}'::jsonb", _JSONB)
+
+
+def json_with(expr, path, new_value):
+    """Build `expr` with `path` set to `new_value`, creating any missing
+    intermediate objects (jsonb_set only creates the last key)
+    """
+    key, rest = path[0], path[1:]
+    value = json_with(expr[key], rest, new_value) if rest else new_value
+    base = _case([(_func.jsonb_typeof(expr) == "object", expr)], else_=_EMPTY_OBJECT)
+    return base.op("||", return_type=_JSONB)(_func.jsonb_build_object(key, value))
+
+
+def mutate(row, column: str, path, new_value, *conditions) -> bool:
+    """Set a nested key of a JSONB column in place ( `row.column[a][b] = new_value` )
+    with one UPDATE, instead of loading the dictionary, changing it and writing
+    the whole column back.
 
     Args:
-        obj: The class property  which is a dictionary
-        dictionary_key (str)
-        internal_key (str)
+        row: The model instance
+        column (str): name of the JSONB column
+        path (tuple): keys leading to the value
         new_value (Any)
+        conditions: guard predicates, see `atomic_update`
     """
-    key = obj[dictionary_key]
-    key[internal_key] = new_value
-    obj[dictionary_key] = key
+    col = getattr(type(row), column)
+    value = json_with(col, path, as_jsonb(new_value))
+    return atomic_update(row, {column: value}, *conditions)
 
 
 # pylint: enable=E1101
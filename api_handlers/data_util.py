@@ -1,17 +1,27 @@
+import config_cache
 from app_init import db, TeamTable, UserTable
 from constants import EVENT_NAMES
 from util import AppException
 from os import environ
 
-# do not store these in database as this is data is only specific to a particular event (music)
-# and we can easily get away with a simple dicitonary access
-MAX_MEMBER_COUNT = {
+# defaults from the env, admins can override them per event by setting
+# `max_players` in the event's config ( no restart needed, see config_cache )
+_DEFAULT_MAX_MEMBER_COUNT = {
     x: int(environ.get(f"{x}_max_players", TeamTable.MAX_MEMBER_COUNT))
     for x in EVENT_NAMES
 }
 del environ
 
 
+def max_member_count(event: str) -> int:
+    config = config_cache.get(event)
+    value = config is not None and (config.config or {}).get("max_players")
+    try:
+        return int(value) if value else _DEFAULT_MAX_MEMBER_COUNT.get(event)
+    except (TypeError, ValueError):
+        return _DEFAULT_MAX_MEMBER_COUNT.get(event)
+
+
 def init_user_event_dict(
     gaming_data: str = None,
     prog: str = None,
@@ -106,3 +116,4 @@ def init_user_music_data_dict(kwargs) -> dict:
 def ensure_safe(d: dict):
     if any(x is None or not isinstance(x, str) or len(x) > 1000 for x in d.values()):
         raise AppException("Invalid data")
+    return d
@@ -1,17 +1,102 @@
-from smtplib import SMTP
-
-from constants import MAIL_USERNAME, MAIL_PASS
+from os import getpid
+from smtplib import SMTP, SMTPException, SMTPRecipientsRefused, SMTPServerDisconnected
+from threading import Lock
+from time import perf_counter, time
 from urllib.parse import quote
 
+import metrics
+from tracing import traced
+from constants import (
+    MAIL_HOST,
+    MAIL_PASS,
+    MAIL_PORT,
+    MAIL_STARTTLS,
+    MAIL_TIMEOUT,
+    MAIL_USERNAME,
+)
+from jobs import enqueue
 
-def _send(email, subject, content):
-    with SMTP("smtp.gmail.com", 587) as smtp:
-        smtp.ehlo()
+# Requests only queue a `send_email` job ( tasks.py ), the worker sends it.
+# The worker keeps one logged in smtp connection and sends every message
+# over it, so a burst of sign-ups costs one handshake instead of one each.
+# A connection idle for longer than this is replaced rather than trusted,
+# gmail drops idle ones after a few minutes.
+_MAX_IDLE = 2 * 60
+
+_smtp = None
+_smtp_pid = None
+_last_used = 0
+_smtp_lock = Lock()
+
+
+def _connect() -> SMTP:
+    start = perf_counter()
+    smtp = SMTP(MAIL_HOST, MAIL_PORT, timeout=MAIL_TIMEOUT)
+    smtp.ehlo()
+    if MAIL_STARTTLS:
         smtp.starttls()
         smtp.ehlo()
+    if MAIL_PASS:
         smtp.login(MAIL_USERNAME, MAIL_PASS)
-        message = f"Subject: {subject}\n\n{content}"
-        smtp.sendmail(MAIL_USERNAME, email, message)
+    metrics.inc("smtp_connects")
+    metrics.histogram("smtp_connect_seconds", perf_counter() - start)
+    return smtp
+
+
+def _close():
+    global _smtp
+    if _smtp is not None:
+        try:
+            _smtp.quit()
+        except (SMTPException, OSError):
+            pass
+    _smtp = None
+
+
+def _connection() -> SMTP:
+    """The process' smtp connection, a new one after a fork or a long idle"""
+    global _smtp, _smtp_pid
+    if _smtp_pid != getpid():
+        # the parent's socket, leave it alone
+        _smtp, _smtp_pid = None, getpid()
+    elif _smtp is not None and time() - _last_used > _MAX_IDLE:
+        _close()
+    if _smtp is None:
+        _smtp = _connect()
+    return _smtp
+
+
+@traced("smtp.send")
+def _send(email, subject, content):
+    """Send one message over the shared connection
+
+    Raises:
+        SMTPRecipientsRefused: the address was rejected, retrying won't help
+        SMTPException / OSError: anything else, worth retrying later
+    """
+    global _last_used
+    message = f"Subject: {subject}\n\n{content}"
+    with _smtp_lock:
+        start = perf_counter()
+        try:
+            try:
+                _connection().sendmail(MAIL_USERNAME, email, message)
+            except SMTPServerDisconnected:
+                # the server hung up since the last message, once more on a
+                # fresh connection
+                _close()
+                _connection().sendmail(MAIL_USERNAME, email, message)
+        except SMTPRecipientsRefused:
+            metrics.inc("emails_rejected")
+            raise
+        except (SMTPException, OSError):
+            # don't reuse a connection in an unknown state
+            _close()
+            metrics.inc("emails_failed")
+            raise
+        _last_used = time()
+    metrics.inc("emails_sent")
+    metrics.histogram("smtp_send_seconds", perf_counter() - start)
 
 
 def get_link(t, token):
@@ -23,6 +108,9 @@ def get_link(t, token):
 
 
 def send_email(token, t_type, email_id):
+    """Queue the email in the current transaction, it goes out once that
+    commits
+    """
     if t_type == "password":
         subject = "Password Reset - Qbytic"
         content = f"You requested a password reset.\nYour reset link:\n{get_link(t_type,token)}"
@@ -32,5 +120,4 @@ def send_email(token, t_type, email_id):
     else:
         subject = t_type
         content = token
-    return _send(email_id, subject, content)
-
+    enqueue("send_email", {"to": email_id, "subject": subject, "content": content})
@@ -1,36 +1,41 @@
 from typing import List
 from psycopg2 import IntegrityError
-from sqlalchemy import func
+from sqlalchemy import func, or_
 from sqlalchemy.sql import column
 
 
-from app_init import TeamTable, UserTable
+from app_init import ClanMembership, TeamTable, UserTable
 from auth_token import require_jwt
-from constants import ALLOW_REMOVALS, ROLE_ID_DICT
-from discord_integrations import set_roles
+from constants import ALLOW_REMOVALS
+from jobs import enqueue
 from response_caching import cache
 from util import AppException
 from util import ParsedRequest as _Parsed
-from util import map_to_list
+from util import map_to_list, sanitize
 
 from .common import (
     add_to_db,
     clean_node,
     delete_from_db,
+    flush,
     get_clan_by_id,
     get_user_by_id,
+    get_users_by_id,
     mutate,
     query_all,
+    reader,
+    reload_on_access,
     save_to_db,
+    savepoint,
 )
 from .cred_manager import CredManager
 from .data_util import (
     EVENT_NAMES,
     GAMES,
-    MAX_MEMBER_COUNT,
     init_user_event_dict,
     init_user_gaming_data_dict,
     init_user_music_data_dict,
+    max_member_count,
 )
 
 
@@ -70,7 +75,12 @@ def register_for_game(request: _Parsed, game: str, creds: CredManager = CredMana
     reg_data = game_data.get(game)
     if reg_data is not None:
         raise AppException("Already submitted details!")
-    mutate(team_data, "game_data", "game", init_user_gaming_data_dict(data, game))
+    mutate(
+        user_data,
+        "team_data",
+        (event, "game_data", game),
+        init_user_gaming_data_dict(data, game),
+    )
     save_to_db()
     return {"user_data": user_data.as_json}
 
@@ -102,10 +112,20 @@ def create_team(request: _Parsed, team_event, creds: CredManager = CredManager):
             members=members,
             leader=creds.user,
         )
-        user.team_data[team_event] = {
-            "name": team_name,
-            "registration_data": validate(registration_data, team_event),
-        }
+        # claim the event slot in the same statement that checks it, so
+        # concurrent requests can't put the user in two clans
+        claimed = mutate(
+            user,
+            "team_data",
+            (team_event,),
+            {
+                "name": team.team_name,
+                "registration_data": validate(registration_data, team_event),
+            },
+            _is_clanless(team_event),
+        )
+        if not claimed:
+            raise AppException("You are already a member of a clan")
 
         add_to_db(team)
     except Exception as e:
@@ -118,50 +138,110 @@ def create_team(request: _Parsed, team_event, creds: CredManager = CredManager):
 @require_jwt(strict=False)
 def get_team(request: _Parsed, clan: str, creds: CredManager = CredManager):
     user = creds.user
-    clan_data = get_clan_by_id(clan)
+    clan_data = get_clan_by_id(clan, session=reader(user))
     json = clan_data.as_json
     if user not in clan_data.members and not creds.is_admin:
         json.pop("_secure_")
     return {"clan_data": json}
 
 
+@require_jwt(strict=False)
+def get_user_clans(request: _Parsed, user: str, creds: CredManager = CredManager):
+    # every clan `user` is a member of, one indexed lookup on clan_membership
+    # instead of reading team_data and fetching each clan separately
+    if user == "me":
+        if creds.user is None:
+            raise AppException("Not Authenticated")
+        user = creds.user
+    user = user.lower()
+    if sanitize(user) != user:
+        raise AppException("User does not exist")
+
+    clans: List[TeamTable] = (
+        reader(creds.user)
+        .query(TeamTable)
+        .join(
+            ClanMembership, ClanMembership.clan == TeamTable.team_name
+        )
+        .filter(
+            ClanMembership.user == user, ClanMembership.kind == ClanMembership.MEMBER
+        )
+        .all()
+    )
+    ret = {}
+    for clan_data in clans:
+        json = clan_data.as_json
+        if creds.user not in clan_data.members and not creds.is_admin:
+            json.pop("_secure_")
+        ret[clan_data.team_event] = json
+    return {"clans": ret}
+
+
+MAX_BATCH_INVITES = 20
+
+
 @require_jwt()
 def add_member(request: _Parsed, clan: str, creds: CredManager = CredManager):
+    """Invite users to the clan, or accept them if they requested to join.
+
+    Takes `{"user": str}` or `{"users": [str, ...]}`, a list is resolved with
+    one query and committed once, every user gets their own result.
+    """
     user = creds.user
     json = request.json
-    to_add = json.get("user")
-    if to_add == user:
+    batch = json.get("users")
+    to_add = batch if batch is not None else [json.get("user")]
+    if not isinstance(to_add, list) or not to_add or len(to_add) > MAX_BATCH_INVITES:
+        raise AppException("Invalid list of users")
+    # lowercase and drop repeats, keeping the order
+    to_add = list(dict.fromkeys(str(x).lower() for x in to_add))
+    if user in to_add:
         raise AppException("You cannot add yourself to a team!")
 
-    clan_data = get_clan_by_id(clan)
-    members = clan_data.members
-    if user not in members and not creds.is_admin:
+    clan_data = get_clan_by_id(clan, lock=True)
+    if user not in clan_data.members and not creds.is_admin:
         raise AppException(f"You cannot edit settings for Clan {clan}")
 
+    addees = {x.user: x for x in get_users_by_id(to_add)}
+    results = {}
+    for name in to_add:
+        try:
+            # a failed user only undoes their own changes
+            with savepoint():
+                _add_or_invite(clan_data, addees.get(name))
+            results[name] = {"success": True}
+        except AppException as e:
+            if batch is None:
+                raise
+            results[name] = {"success": False, "error": f"{e}"}
+
+    save_to_db()
+    ret = {"clan_data": clan_data.as_json}
+    if batch is not None:
+        ret["results"] = results
+    return ret
+
+
+def _add_or_invite(clan_data: TeamTable, addee_data: UserTable):
+    if addee_data is None:
+        raise AppException("User does not exist")
     clan_event = clan_data.team_event
-    maximum = MAX_MEMBER_COUNT.get(clan_event)
-    if maximum == len(members):
+    if max_member_count(clan_event) == len(clan_data.members):
         raise AppException(f"Clan has reached the max limit of players")
 
-    addee_data = get_user_by_id(to_add)
-
     assert_user_is_clanless(addee_data, clan_event)
 
-    clan_requests = clan_data.clan_requests
-    if to_add in clan_requests:
+    if addee_data.user in clan_data.clan_requests:
         add_player_with_side_effects(clan_data, addee_data)
 
     else:
         # the player hasn't requested to join, invite them
         invites = addee_data.clan_invites.get(clan_event) or []
 
-        if clan in invites:
+        if clan_data.team_name in invites:
             raise AppException("Already Invited!")
         add_player_invite(clan_data, addee_data)
 
-    save_to_db()
-    return {"clan_data": clan_data.as_json}
-
 
 @require_jwt()
 def remove_member(request: _Parsed, clan: str, creds: CredManager = CredManager):
@@ -170,7 +250,7 @@ def remove_member(request: _Parsed, clan: str, creds: CredManager = CredManager)
     user = creds.user
     json = request.json
     to_remove = json.get("user")
-    clan_data = get_clan_by_id(clan)
+    clan_data = get_clan_by_id(clan, lock=True)
 
     members = clan_data.members
 
@@ -209,9 +289,9 @@ def request_to_join(
     )
     assert_user_is_clanless(user_data, event_name, prefix="You are")
 
-    maximum = MAX_MEMBER_COUNT.get(event_name)
+    maximum = max_member_count(event_name)
 
-    clan_data = get_clan_by_id(clan)
+    clan_data = get_clan_by_id(clan, lock=True)
     if len(clan_data.members) == maximum:
         raise AppException(f"Clan {clan_data.team_name} already has {maximum} members")
 
@@ -227,12 +307,13 @@ def request_to_join(
     add_registration_data(user_data, event_name, registration_data)
 
     save_to_db()
+    reload_on_access(user_data, "memberships")
     return {"user_data": user_data.as_json}
 
 
 @cache("team-list", 10)
 def team_list():
-    all_teams: List[TeamTable] = TeamTable.query.order_by(
+    all_teams: List[TeamTable] = reader().query(TeamTable).order_by(
         TeamTable.is_disqualified.asc(),  # disqualified team placed last
         TeamTable.team_name != "admin",  # above that we have admins
         (
@@ -280,17 +361,15 @@ def add_player_with_side_effects(clan_data, user_data):
     add_player_to_clan(clan_data, user_data)
     remove_player_invite(clan_data, user_data)
     remove_player_request(clan_data, user_data)
-    event_name = clan_data.team_event
-
-    try:
-        del user_data.clan_invites[event_name]
-    except:
-        pass
 
-    try:
-        del user_data.clan_requests[event_name]
-    except:
-        pass
+    # joining a clan cancels every other invite and request for the event
+    flush()
+    ClanMembership.query.filter(
+        ClanMembership.user == user_data.user,
+        ClanMembership.event == clan_data.team_event,
+        ClanMembership.kind != ClanMembership.MEMBER,
+    ).delete(synchronize_session=False)
+    reload_on_access(user_data, "memberships")
 
     update_discord_roles(user_data)
 
@@ -298,95 +377,104 @@ def add_player_with_side_effects(clan_data, user_data):
 def add_registration_data(
     user_data: UserTable, event_name: str, registration_data: dict = None
 ):
-    if user_data.team_data[event_name].get("registration_data") is None:
-        user_data.team_data["registration_data"] = validate(
-            registration_data, event_name, None
+    event_data = user_data.team_data.get(event_name) or {}
+    if event_data.get("registration_data") is None:
+        mutate(
+            user_data,
+            "team_data",
+            (event_name, "registration_data"),
+            validate(registration_data, event_name, None),
         )
 
 
-# remove clan sent invite from both clan data and user data
+# remove clan sent invite
 def remove_player_invite(clan_data: TeamTable, user_data: UserTable):
-    _internal_remove_linked_data(clan_data, user_data, "clan_invites")
+    _internal_remove_linked_data(clan_data, user_data, ClanMembership.INVITE)
 
 
-# remove user sent request from both clan data and user data
+# remove user sent request
 def remove_player_request(clan_data: TeamTable, user_data: UserTable):
-    _internal_remove_linked_data(clan_data, user_data, "clan_requests")
+    _internal_remove_linked_data(clan_data, user_data, ClanMembership.REQUEST)
 
 
 def remove_player_from_clan(clan_data: TeamTable, user_data: UserTable):
-    user_name = user_data.user
-
-    members = clan_data.members
-    if user_name in members:
-        members.remove(user_name)
+    _internal_remove_linked_data(clan_data, user_data, ClanMembership.MEMBER)
     event = clan_data.team_event
     clan_dict = user_data.team_data.get(event)
     if clan_dict is not None:
-        mutate(user_data.team_data, event, "name", None)
+        mutate(user_data, "team_data", (event, "name"), None)
     update_discord_roles(user_data)
 
 
 def add_player_invite(clan_data: TeamTable, user_data: UserTable):
-    _internal_add_linked_data(clan_data, user_data, "clan_invites")
+    _internal_add_linked_data(clan_data, user_data, ClanMembership.INVITE)
 
 
 def add_player_request(clan_data: TeamTable, user_data: UserTable):
-    _internal_add_linked_data(clan_data, user_data, "clan_requests")
+    _internal_add_linked_data(clan_data, user_data, ClanMembership.REQUEST)
 
 
 # add a player to clan
+# callers hold the clan row lock ( get_clan_by_id(..., lock=True) ) so the
+# member count below can't change under us
 def add_player_to_clan(clan_data: TeamTable, user_data: UserTable):
-    if user_data.user not in clan_data.members:
-        clan_data.members.append(user_data.user)
+    user_name = user_data.user
     event = clan_data.team_event
-    _dict = user_data.team_data.get(event)
-    if _dict is None:
-        user_data.team_data[event] = {}
-    mutate(user_data.team_data, event, "name", clan_data.team_name)
 
-    # if len(clan_data.members) == MAX_MEMBER_COUNT[event]:
-    #     clan_data.clan_invites.clear()
-    #     clan_data.clan_requests.clear()
+    if user_name not in clan_data.members:
+        if len(clan_data.members) >= max_member_count(event):
+            raise AppException("Clan has reached the max limit of players")
+        _internal_add_linked_data(clan_data, user_data, ClanMembership.MEMBER)
+
+    if not mutate(
+        user_data,
+        "team_data",
+        (event, "name"),
+        clan_data.team_name,
+        _is_clanless(event, clan_data.team_name),
+    ):
+        raise AppException(f"{user_name} is already a member of another clan")
 
 
-def _internal_remove_linked_data(clan_data: TeamTable, user_data: UserTable, attr: str):
-    # both remove_player_request and remove_player_invite do the exact same thing, just with different columns
-    # so we abstract it out in a simple dynamic method
+def _find_link(clan_data: TeamTable, user_name: str, kind: str) -> ClanMembership:
+    for m in clan_data.memberships:
+        if m.user == user_name and m.kind == kind:
+            return m
+    return None
 
-    user_name = user_data.user
-    clan_name = clan_data.team_name
-    event_name = clan_data.team_event
 
-    clan_attribute_value_list: list = getattr(clan_data, attr)
-    if user_name in clan_attribute_value_list:
-        clan_attribute_value_list.remove(user_name)
-    u_attr = getattr(user_data, attr)
-    user_attribute_value_list: list = u_attr.get(event_name)
-    if user_attribute_value_list is not None and clan_name in user_attribute_value_list:
-        user_attribute_value_list.remove(clan_name)
-        u_attr[event_name] = user_attribute_value_list
+def _internal_remove_linked_data(clan_data: TeamTable, user_data: UserTable, kind: str):
+    # invites, requests and members are all rows of clan_membership,
+    # removing one from the clan's collection deletes it (delete-orphan)
+    link = _find_link(clan_data, user_data.user, kind)
+    if link is not None:
+        clan_data.memberships.remove(link)
 
 
-def _internal_add_linked_data(clan_data: TeamTable, user_data: UserTable, attr: str):
-    user_name = user_data.user
-    clan_name = clan_data.team_name
-    event_name = clan_data.team_event
+def _internal_add_linked_data(clan_data: TeamTable, user_data: UserTable, kind: str):
+    if _find_link(clan_data, user_data.user, kind) is None:
+        clan_data.memberships.append(
+            ClanMembership(
+                clan=clan_data.team_name,
+                user=user_data.user,
+                kind=kind,
+                event=clan_data.team_event,
+            )
+        )
 
-    clan_attribute = getattr(clan_data, attr)
-    if user_name not in clan_attribute:
-        clan_attribute.append(user_name)
 
-    u_attr = getattr(user_data, attr)
-    user_attr_value = u_attr.get(event_name) or []
-    if clan_name not in user_attr_value:
-        user_attr_value.append(clan_name)
-        u_attr[event_name] = user_attr_value
+def _is_clanless(event: str, allowed_clan: str = None):
+    # guard for UserTable updates: no clan for `event` yet (or already `allowed_clan`)
+    name = UserTable.team_data[event]["name"].astext
+    if allowed_clan is None:
+        return name.is_(None)
+    return or_(name.is_(None), name == allowed_clan)
 
 
 def update_discord_roles(user_data: UserTable):
-    roles = []
-    for event, data in user_data.team_data.items():
-        if data.get("name") is not None:
-            roles.append(ROLE_ID_DICT[event])
-    set_roles(user_data.discord_id, roles)
+    # sent by worker.py once this request commits ( tasks.sync_roles ),
+    # the clan operation doesn't wait for Discord. Changes made before the
+    # job runs share it
+    if user_data.discord_id:
+        user = user_data.user
+        enqueue("sync_roles", {"user": user}, dedupe_key=f"sync_roles:{user}")
@@ -1,7 +1,10 @@
 from time import time
 
+import metrics
+import shared_state
 from app_init import UserTable
 from auth_token import require_jwt
+from constants import MAIL_MAX_PER_WINDOW, MAIL_RESEND_SECONDS, MAIL_WINDOW_SECONDS
 from danger import (
     check_password_hash,
     create_token,
@@ -58,6 +61,44 @@ def verify_password(token: str, new_password: str):
     save_to_db()
 
 
+def _may_send(kind: str, user: str) -> bool:
+    """Record a `kind` email to `user` in the dyno's ledger, False if one
+    went out too recently or too many did this window
+
+    Checked before the token is made, a suppressed request costs no scrypt.
+    The earlier email's token is still good for three hours, so the user
+    just uses that one.
+    """
+    now = time()
+    # both entries expire a fixed time after they were started, asking again
+    # doesn't extend them, or anyone could keep someone's emails blocked
+    last, _ = shared_state.update(
+        f"mail-last:{kind}:{user}",
+        lambda current: current or (now, 0),
+        ttl=lambda value: value[0] + MAIL_RESEND_SECONDS - now,
+    )
+    taken = [last == now]
+
+    def take(current):
+        if current is None:
+            return 1, now
+        sent, window_start = current
+        if sent >= MAIL_MAX_PER_WINDOW:
+            taken[0] = False
+            return current
+        return sent + 1, window_start
+
+    if taken[0]:
+        shared_state.update(
+            f"mail:{kind}:{user}",
+            take,
+            ttl=lambda value: value[1] + MAIL_WINDOW_SECONDS - now,
+        )
+    if not taken[0]:
+        metrics.inc("emails_suppressed")
+    return taken[0]
+
+
 def assert_token_is_valid(token: dict):
     if token is None:
         raise AppException("Token Expired")
@@ -67,14 +108,21 @@ def api_forgot_password(req: ParsedRequest):
     json = req.json
     user = json["user"]
     data = get_user_by_id(user)
+    if not _may_send("password", data.user):
+        # same answer either way, nothing to learn by asking again
+        return {"success": True}
     token = create_password_verification_token(data)
     send_email(token, "password", data.email)
+    save_to_db()
     return {"success": True}
 
 
 @require_jwt()
 def api_verify_email(req: ParsedRequest, creds=CredManager):
     data = get_user_by_id(creds.user)
+    if not _may_send("email", data.user):
+        return {"success": True}
     token = create_email_verification_token(data)
     send_email(token, "email", data.email)
+    save_to_db()
     return {"success": True}
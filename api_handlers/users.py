@@ -2,6 +2,7 @@ from typing import List
 
 from flask import request as flask_request
 from psycopg2 import IntegrityError
+from sqlalchemy.orm import selectinload
 
 from app_init import UserTable
 from auth_token import (
@@ -18,12 +19,20 @@ from danger import (
     decode_token,
 )
 from discord_integrations import exchange_code
+from rate_limit import charge_account, clear_account
 from response_caching import cache
 from util import AppException
 from util import ParsedRequest as _Parsed
 from util import json_response, map_to_list
 
-from .common import add_to_db, clean_node, get_user_by_id, save_to_db
+from .common import (
+    add_to_db,
+    clean_node,
+    get_user_by_id,
+    mark_write,
+    reader,
+    save_to_db,
+)
 from .cred_manager import CredManager
 from .data_util import init_user_event_dict
 
@@ -47,6 +56,7 @@ def register(request: _Parsed):
             team_data=init_user_event_dict(),
         )
         add_to_db(user_data)
+        mark_write(user_data.user)
         return user_data.as_json
     except Exception as e:
         if isinstance(getattr(e, "orig", None), IntegrityError):
@@ -67,10 +77,12 @@ def login(request: _Parsed):
     if invalids:
         raise AppException(f"Invalid {' and '.join(invalids)}")
     user_data = get_user_by_id(user)
+    username = user_data.user
     password_hash = user_data.password_hash
+    charge_account("login", username)
     if not check_password_hash(password_hash, password):
         raise AppException("Incorrect Password")
-    username = user_data.user
+    clear_account("login", username)
     access_token = create_token(issue_access_token(username, user_data.is_admin))
 
     refresh_token = create_token(issue_refresh_token(username, password_hash))
@@ -142,23 +154,27 @@ def get_user_details(request: _Parsed, user: str, creds: CredManager = CredManag
         if current_user is not None:
             return self_details(request, creds)
         raise AppException("Not Authenticated")
-    user_details = get_user_by_id(user)
+    user_details = get_user_by_id(user, session=reader(current_user))
     json = user_details.as_json
     json.pop("_secure_")
     return {"user_data": json}
 
 
 def self_details(request: _Parsed, creds: CredManager):
-    req = get_user_by_id(creds.user)
+    req = get_user_by_id(creds.user, session=reader(creds.user))
     resp = req.as_json
     return {"user_data": resp}
 
 
 @cache("user-list", 15)
 def user_list():
-    all_users: List[UserTable] = UserTable.query.order_by(
-        UserTable.is_admin.asc(), UserTable.created_at.asc()
-    ).all()
+    all_users: List[UserTable] = (
+        reader()
+        .query(UserTable)
+        .options(selectinload(UserTable.memberships))
+        .order_by(UserTable.is_admin.asc(), UserTable.created_at.asc())
+        .all()
+    )
     return {"users": map_to_list(clean_node, all_users)}
 
 
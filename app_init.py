@@ -1,17 +1,24 @@
+from hmac import compare_digest
+from math import ceil
 from os import environ
 from re import compile as cmpl
-from time import time
+from time import perf_counter, time
 from typing import Dict, List, Union
 
-from flask import Flask, Response, request, send_from_directory
+from flask import Flask, Response, g, request, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
-from floodgate import guard
 
 from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.ext.mutable import MutableDict, MutableList
 
-from constants import EVENT_NAMES, IS_HEROKU
+import admission
+import metrics
+import query_log
+import rate_limit
+import tracing
+from constants import EVENT_NAMES, TRACE_TOKEN
 from danger import check_password_hash, generate_password_hash
+from db_pool import engine_options, warm_up
 from set_env import setup_env
 from util import (
     AppException,
@@ -30,19 +37,106 @@ app.secret_key = environ.get("FLASK_SECRET")
 database_url: str = environ.get("DATABASE_URL")
 
 app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+# optional read-only replica for GET handlers, point it at a second local
+# database to try the routing out
+replica_url: str = environ.get("REPLICA_DATABASE_URL")
+if replica_url:
+    app.config["SQLALCHEMY_BINDS"] = {"replica": replica_url}
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options()
 
 db = SQLAlchemy(app)
+# binds={} so that every table goes to the replica engine,
+# not the per-table mapping flask_sqlalchemy builds for the primary
+replica_session = (
+    db.create_scoped_session(
+        {"bind": db.get_engine(app, bind="replica"), "binds": {}}
+    )
+    if replica_url
+    else None
+)
 safe_mkdir("@cache")
 
-# not exactly as we have 4 workers running, it's basically a lottery if you hit the same worker thrice
-# gate = Gate(use_heroku_ip_resolver=IS_HEROKU, limit=1, min_requests=3)
+
+@app.teardown_appcontext
+def remove_replica_session(exc):
+    if replica_session is not None:
+        replica_session.remove()
+
+
+def warm_up_pool():
+    warm_up(db.engine)
+
+
+# registered first, so the time spent in the checks below counts too
+@app.before_request
+def start_request():
+    g.request_start = perf_counter()
+    g.sql = [0, 0.0]
+    g.sql_log = query_log.start()
+    # sampled, or every time for a request sent with the trace token
+    tracing.start(request.endpoint or "unknown", force=_trace_requested())
+
+
+def _trace_requested() -> bool:
+    token = request.headers.get("x-trace")
+    if not TRACE_TOKEN or not token:
+        return False
+    return compare_digest(token.encode(), TRACE_TOKEN.encode())
 
 
+# per route limits, see rate_limit.py, the buckets are shared by all workers
 @app.before_request
-@guard(ban_time=5, ip_resolver="heroku" if IS_HEROKU else None,request_count=3,per=1)
 def gate_check():
-    pass
+    wait = rate_limit.check(request)
+    if wait:
+        seconds = str(ceil(wait))
+        return json_response(
+            {"error": f"You have been rate limited, try again in {seconds} seconds"},
+            status=429,
+            headers={"x-rate-limit": "1", "x-time-left": seconds, "Retry-After": seconds},
+        )
+
+
+# runs after gate_check, rate limited requests don't take a slot
+@app.before_request
+def admission_check():
+    klass, retry_after = admission.admit(request)
+    if retry_after:
+        return json_response(
+            {"error": f"Server busy, try again in {retry_after} seconds"},
+            status=503,
+            headers={"Retry-After": str(retry_after)},
+        )
+    g.admitted = klass
+
+
+@app.teardown_request
+def admission_release(exc):
+    klass = g.pop("admitted", None)
+    if klass is not None:
+        admission.release(klass)
+
+
+# latency and sql use per route, aggregated across workers for
+# /admin/metrics/prometheus/
+@app.teardown_request
+def record_request(exc):
+    start = g.pop("request_start", None)
+    if start is None:
+        return
+    route = request.endpoint or "unknown"
+    statements, sql_seconds = g.pop("sql")
+    sql_log = g.pop("sql_log")
+    metrics.histogram("request_seconds", perf_counter() - start, route=route)
+    metrics.histogram(
+        "request_sql_statements", statements, metrics.COUNT_BUCKETS, route=route
+    )
+    metrics.histogram("request_sql_seconds", sql_seconds, route=route)
+    if sql_log is not None:
+        query_log.report(route, sql_log)
+    tracing.finish(route=route, method=request.method)
+    metrics.flush()
 
 
 @app.route("/robots.txt")
@@ -112,12 +206,35 @@ class UserTable(db.Model):
     created_at: int = db.Column(db.Integer)
     is_admin: bool = db.Column(db.Boolean)
     has_verified_email: bool = db.Column(db.Boolean)
-    clan_invites: InvitesOrRequests = db.Column(MutableDict.as_mutable(JSONB))
-    # list of users that want to join the clan
-    clan_requests: InvitesOrRequests = db.Column(MutableDict.as_mutable(JSONB))
+    # invites and requests live in clan_membership, `clan_invites` and
+    # `clan_requests` below are read-only views over it.
+    # Links are created and removed through TeamTable.memberships
+    memberships: List["ClanMembership"] = db.relationship(
+        "ClanMembership", viewonly=True, order_by="ClanMembership.created_at"
+    )
     # =================================================================
+
+    # lookups compare lower(user), see api_handlers.common.get_user_by_id
+    __table_args__ = (db.Index("ix_user_table_lower_user", db.func.lower(user)),)
     # pylint: enable=E1101
 
+    # clan names per event, the same shape the old JSONB columns had
+    @property
+    def clan_invites(self) -> InvitesOrRequests:
+        return self._clans_by_event(ClanMembership.INVITE)
+
+    # list of clans this user has requested to join
+    @property
+    def clan_requests(self) -> InvitesOrRequests:
+        return self._clans_by_event(ClanMembership.REQUEST)
+
+    def _clans_by_event(self, kind: str) -> InvitesOrRequests:
+        ret = {}
+        for m in self.memberships:
+            if m.kind == kind:
+                ret.setdefault(m.event, []).append(m.clan)
+        return ret
+
     @property
     def as_json(self):
         return {
@@ -152,8 +269,6 @@ class UserTable(db.Model):
         is_disqualified: bool = False,
         disqualification_reason: str = None,
         has_verified_email: bool = False,
-        clan_invites: InvitesOrRequests = {},
-        clan_requests: InvitesOrRequests = {},
         created_at: int = None,
     ):
         raise_if_invalid_data(user, name, email, password)
@@ -170,8 +285,6 @@ class UserTable(db.Model):
         self.discord_token_expires_in = discord_token_expires_in
         self.is_admin = is_admin
         self.has_verified_email = has_verified_email
-        self.clan_invites = clan_invites
-        self.clan_requests = clan_requests
         self.created_at = time()
 
     def __setattr__(self, key: str, val):
@@ -209,7 +322,18 @@ class UserTable(db.Model):
 
         super().__setattr__(key, val)
 
-    def _validate_user(self, user: str):
+    @classmethod
+    def validate_new_user(cls, user: str, name: str, email: str, password: str):
+        """The checks __init__ and __setattr__ run, for rows that are
+        inserted without going through the model ( bulk imports )
+        """
+        raise_if_invalid_data(user, name, email, password)
+        cls._validate_user(user.lower())
+        cls._validate_email(email)
+        cls._validate_password(password)
+
+    @staticmethod
+    def _validate_user(user: str):
         length = len(user)
         if length > 30:
             raise AppException("Username cannot be longer than 30 characters")
@@ -218,16 +342,19 @@ class UserTable(db.Model):
         if sanitize(user) != user:
             raise AppException("Username cannot have special characters or whitespace")
 
-    def _validate_password(self, password: str):
+    @staticmethod
+    def _validate_password(password: str):
         length = len(password)
         if length < 4:
             raise AppException("Password cannot be shorter than 4 characters")
 
-    def _validate_discord(self, tag: str):
-        if self._discord_id_re(tag) is None:
+    @classmethod
+    def _validate_discord(cls, tag: str):
+        if cls._discord_id_re(tag) is None:
             raise AppException("Invalid discord ID")
 
-    def _validate_email(self, mail: str):
+    @staticmethod
+    def _validate_email(mail: str):
         validate_email_address(mail)
 
     def _is_same_value(self, key: str, val) -> bool:
@@ -247,17 +374,15 @@ class TeamTable(db.Model):
     # pylint: disable=E1101
     team_name: str = db.Column(db.String(30), nullable=False, primary_key=True)
     team_event: str = db.Column(db.String(30), nullable=False)
-    # list of player usernames that are a part of this team
-    members: ListOfDict = db.Column(MutableList.as_mutable(ARRAY(db.String(30))))
     # leader of the team, by default the player who created the clan
     leader: str = db.Column(db.String(30), nullable=False)
-    # list of users that this clan has invited
-    clan_invites: ListOfStrings = db.Column(
-        MutableList.as_mutable(ARRAY(db.String(30)))
-    )
-    # list of users that want to join the clan
-    clan_requests: ListOfStrings = db.Column(
-        MutableList.as_mutable(ARRAY(db.String(30)))
+    # members, invites and requests, always needed to render or check a clan
+    # so they are loaded with one extra IN query for the whole result set
+    memberships: List["ClanMembership"] = db.relationship(
+        "ClanMembership",
+        cascade="all, delete-orphan",
+        order_by="ClanMembership.created_at",
+        lazy="selectin",
     )
     # mapping of the event names and their scores and the required data
     event_data: Dict = db.Column(MutableDict.as_mutable(JSONB), nullable=False)
@@ -268,8 +393,50 @@ class TeamTable(db.Model):
     submissions: SubmissionType = db.Column(MutableList.as_mutable(ARRAY(db.String)))
     score: ListOfInt = db.Column(MutableList.as_mutable(ARRAY(db.Integer)))
 
+    __table_args__ = (
+        db.Index("ix_team_table_lower_team_name", db.func.lower(team_name)),
+    )
     # pylint: enable=E1101
 
+    # list of player usernames that are a part of this team
+    @property
+    def members(self) -> ListOfStrings:
+        return self._users(ClanMembership.MEMBER)
+
+    @members.setter
+    def members(self, val: ListOfStrings):
+        self._set_users(ClanMembership.MEMBER, val)
+
+    # list of users that this clan has invited
+    @property
+    def clan_invites(self) -> ListOfStrings:
+        return self._users(ClanMembership.INVITE)
+
+    @clan_invites.setter
+    def clan_invites(self, val: ListOfStrings):
+        self._set_users(ClanMembership.INVITE, val)
+
+    # list of users that want to join the clan
+    @property
+    def clan_requests(self) -> ListOfStrings:
+        return self._users(ClanMembership.REQUEST)
+
+    @clan_requests.setter
+    def clan_requests(self, val: ListOfStrings):
+        self._set_users(ClanMembership.REQUEST, val)
+
+    def _users(self, kind: str) -> ListOfStrings:
+        return [m.user for m in self.memberships if m.kind == kind]
+
+    def _set_users(self, kind: str, val: ListOfStrings):
+        keep = [m for m in self.memberships if m.kind != kind]
+        self.memberships = keep + [
+            ClanMembership(
+                clan=self.team_name, user=user, kind=kind, event=self.team_event
+            )
+            for user in val or ()
+        ]
+
     @property
     def as_json(self):
         return {
@@ -363,6 +530,62 @@ class TeamTable(db.Model):
         super().__setattr__(key, val)
 
 
+class ClanMembership(db.Model):
+    """One row per (clan, user) link: a member, an outstanding invite from the
+    clan or a request from the user. Replaces the ARRAY columns on TeamTable
+    and the per-event JSONB lists on UserTable, which stored every link twice.
+    """
+
+    MEMBER = "member"
+    INVITE = "invite"
+    REQUEST = "request"
+    # pylint: disable=E1101
+    clan: str = db.Column(
+        db.String(30),
+        db.ForeignKey("team_table.team_name", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    user: str = db.Column(
+        db.String(30),
+        db.ForeignKey("user_table.user", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    kind: str = db.Column(db.String(10), primary_key=True)
+    event: str = db.Column(db.String(30), primary_key=True)
+    # keeps the list order of the old array columns
+    created_at: float = db.Column(db.Float, nullable=False)
+    # pylint: enable=E1101
+
+    __table_args__ = (
+        # "which clans invited me" / "which clans did I ask to join"
+        db.Index("ix_clan_membership_user_kind_event", "user", "kind", "event"),
+        # a user can only be in one clan per event
+        db.Index(
+            "ux_clan_membership_member_event",
+            "user",
+            "event",
+            unique=True,
+            postgresql_where=db.text("kind = 'member'"),
+        ),
+    )
+
+    def __init__(
+        self,
+        clan: str = None,
+        user: str = None,
+        kind: str = None,
+        event: str = None,
+        created_at: float = None,
+    ):
+        if kind not in (self.MEMBER, self.INVITE, self.REQUEST):
+            raise AppException(f"Invalid membership kind {kind}")
+        self.clan = clan
+        self.user = user
+        self.kind = kind
+        self.event = event
+        self.created_at = created_at or time()
+
+
 ConfigType = Dict[str, Union[Dict, str]]
 
 
@@ -383,6 +606,74 @@ class EventConfig(db.Model):
         self.config = config
 
 
+class Job(db.Model):
+    """A unit of background work, see jobs.py. Rows are written in the same
+    transaction as the change that needs them and deleted once they ran.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DEAD = "dead"
+    # pylint: disable=E1101
+    id: int = db.Column(db.BigInteger, primary_key=True)
+    kind: str = db.Column(db.String(30), nullable=False)
+    payload: dict = db.Column(JSONB, nullable=False)
+    status: str = db.Column(db.String(10), nullable=False)
+    attempts: int = db.Column(db.Integer, nullable=False)
+    # when a pending job is due, or when a running job's lease runs out
+    run_at: float = db.Column(db.Float, nullable=False)
+    created_at: float = db.Column(db.Float, nullable=False)
+    last_error: str = db.Column(db.Text)
+    # at most one pending job per key, see jobs.enqueue
+    dedupe_key: str = db.Column(db.String(100))
+    # pylint: enable=E1101
+
+    __table_args__ = (
+        # what the worker polls for
+        db.Index(
+            "ix_job_due_run_at",
+            "run_at",
+            postgresql_where=db.text("status <> 'dead'"),
+        ),
+        db.Index(
+            "ux_job_pending_dedupe_key",
+            "dedupe_key",
+            unique=True,
+            postgresql_where=db.text("status = 'pending'"),
+        ),
+    )
+
+    def __init__(
+        self,
+        kind: str = None,
+        payload: dict = None,
+        run_at: float = None,
+        dedupe_key: str = None,
+    ):
+        self.kind = kind
+        self.payload = payload or {}
+        self.status = self.PENDING
+        self.attempts = 0
+        self.created_at = time()
+        self.run_at = run_at or self.created_at
+        self.dedupe_key = dedupe_key
+
+
+class WorkerMetrics(db.Model):
+    """Metrics snapshots of the job workers. Heroku routes no traffic to a
+    worker dyno, so they're kept here for /admin/metrics/prometheus/ to add
+    to the web workers' numbers.
+    """
+
+    # a worker that stopped saving is left out after this many seconds
+    MAX_AGE = 5 * 60
+    # pylint: disable=E1101
+    worker: str = db.Column(db.String(50), primary_key=True)
+    snapshot: dict = db.Column(JSONB, nullable=False)
+    updated_at: float = db.Column(db.Float, nullable=False)
+    # pylint: enable=E1101
+
+
 def raise_if_invalid_data(*args):
     if any(not x or not ((x).strip() if isinstance(x, str) else True) for x in args):
         raise AppException("Invalid Data")
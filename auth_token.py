@@ -1,6 +1,6 @@
 """Decorators that ensure authentication is provided
 """
-from flask import request, make_response, Response
+from flask import g, request, make_response, Response
 from danger import (
     decode_token as decode,
     ACCESS_TOKEN,
@@ -9,6 +9,7 @@ from danger import (
     generate_password_hash,
 )
 from api_handlers.common import get_user_by_id
+from rate_limit import charge_account, clear_account
 from util import AppException, json_response, ParsedRequest
 from api_handlers.cred_manager import CredManager
 
@@ -19,7 +20,10 @@ def require_jwt(strict=True):
     def wrapper(func):
         def run(*args, **kwargs):
             access = get_token(strict=strict)
-            kwargs["creds"] = CredManager(access)
+            creds = CredManager(access)
+            # save_to_db() uses it for read-your-writes routing
+            g.user = creds.user
+            kwargs["creds"] = creds
 
             return func(*args, **kwargs)
 
@@ -32,8 +36,10 @@ def regenerate_access_token(refresh: dict) -> dict:
     user = refresh.get("user")
     integrity = refresh.get("integrity")
     data = get_user_by_id(user)
+    charge_account("refresh", data.user)
     current = data.user + data.password_hash
     if check(integrity, current):
+        clear_account("refresh", data.user)
         return (
             issue_access_token(user, data.is_admin),
             issue_refresh_token(user, data.password_hash),
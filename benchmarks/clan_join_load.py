@@ -0,0 +1,192 @@
+"""End to end clan join load test against the mock Discord API
+
+    python benchmarks/clan_join_load.py [--clans 20] [--threads 8]
+        [--workers 2] [--latency 0.1] [--failures 0.02] [--rate-limit 10/1]
+
+Runs the app in-process ( flask test client ) against DATABASE_URL, so point
+that at a scratch database: it creates users named l<run>x<n> and their
+clans. benchmarks/mock_discord.py stands in for discord, with the given
+latency, share of 500s and per-route rate limit.
+
+    setup   register, link discord through the mock, create the clans
+    joins   every member asks to join and the leader accepts, each request
+            timed, this is what a user waits for
+    sync    `--workers` job worker threads run the queued role syncs, timed
+            from each accept until the mock holds the member's event role
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+from os.path import abspath, dirname
+from sys import path
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep, time
+
+path.insert(0, dirname(dirname(abspath(__file__))))
+path.insert(0, dirname(abspath(__file__)))
+
+import mock_discord
+
+EVENT = "prog"
+
+
+def percentiles(values: list) -> str:
+    if not values:
+        return "-"
+    values = sorted(values)
+    pick = lambda p: values[min(int(len(values) * p), len(values) - 1)] * 1e3
+    return f"p50 {pick(0.5):7.1f}  p90 {pick(0.9):7.1f}  p99 {pick(0.99):7.1f} ms"
+
+
+class Client:
+    """One simulated user, with their own address for the rate limiter"""
+
+    def __init__(self, app, name: str, n: int):
+        self.name = name
+        self.http = app.test_client()
+        self.environ = {"REMOTE_ADDR": f"10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}"}
+        self.token = None
+
+    def call(self, method: str, url: str, body: dict = None):
+        headers = {"x-access-token": self.token} if self.token else {}
+        while True:
+            response = self.http.open(
+                url,
+                method=method,
+                json=body,
+                headers=headers,
+                environ_base=self.environ,
+            )
+            # rate limited or shed, back off like a well behaved client
+            if response.status_code not in (429, 503):
+                break
+            sleep(float(response.headers.get("Retry-After", 1)))
+        data = response.get_json() or {}
+        if "error" in data:
+            raise RuntimeError(f"{method} {url}: {data['error']}")
+        return response, data
+
+
+def setup(app, prefix: str, clans: int, size: int, threads: int):
+    password = "load-test"
+    users = [f"{prefix}x{i}" for i in range(clans * size)]
+    clients = {u: Client(app, u, i) for i, u in enumerate(users)}
+
+    def prepare(user):
+        client = clients[user]
+        client.call(
+            "POST",
+            "/users/register/",
+            dict(user=user, name=user, email=f"{user}@example.com", password=password),
+        )
+        response, _ = client.call("POST", "/users/login/", dict(user=user, password=password))
+        client.token = response.headers["x-access-token"]
+        client.call("POST", "/u/discord/auth/code/", {"code": user})
+
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(prepare, users))
+
+    teams = []
+    for c in range(clans):
+        leader, *members = users[c * size : (c + 1) * size]
+        clan = f"{prefix}c{c}"
+        clients[leader].call("POST", f"/{EVENT}/clans/create/", {"team_name": clan})
+        teams.append((clan, clients[leader], [clients[m] for m in members]))
+    return teams
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--clans", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--failures", type=float, default=0.02)
+    parser.add_argument("--rate-limit", type=mock_discord.rate_limit, default=(10, 1.0))
+    args = parser.parse_args()
+
+    # no failures while setting up, the oauth POSTs aren't retried
+    server = mock_discord.serve(latency=args.latency, rate_limit=args.rate_limit)
+    environ["DISCORD_API_ENDPOINT"] = mock_discord.endpoint(server)
+
+    import jobs
+    import tasks  # registers the job handlers
+    from api_handlers.data_util import max_member_count
+    from app import app
+    from constants import ROLE_ID_DICT
+
+    role = ROLE_ID_DICT[EVENT]
+    size = max_member_count(EVENT)
+    prefix = f"l{int(time()) % 100000}"
+    start = perf_counter()
+    teams = setup(app, prefix, args.clans, size, args.threads)
+    print(f"setup: {args.clans} clans of {size} in {perf_counter() - start:.1f}s")
+
+    # run the role syncs queued during setup before timing anything
+    with app.app_context():
+        while jobs.run_one():
+            pass
+
+    lock = Lock()
+    latencies = []
+    joined = {}  # discord id -> when the leader's accept returned
+
+    def join(team):
+        clan, leader, members = team
+        for member in members:
+            t = perf_counter()
+            member.call("GET", f"/{EVENT}/clans/{clan}/request/")
+            t1 = perf_counter()
+            leader.call("POST", f"/clans/{clan}/members/add/", {"user": member.name})
+            t2 = perf_counter()
+            with lock:
+                latencies.append(t2 - t1)
+                latencies.append(t1 - t)
+                joined[mock_discord.discord_id(member.name)] = t2
+
+    stop = Event()
+
+    def work():
+        with app.app_context():
+            while not stop.is_set():
+                if not jobs.run_one():
+                    sleep(0.02)
+
+    workers = [Thread(target=work, daemon=True) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    server.failures = args.failures
+    patches_before = server.patches
+    start = perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        list(pool.map(join, teams))
+    took = perf_counter() - start
+    print(
+        f"joins: {len(joined)} in {took:.1f}s, {len(latencies) / took:.0f} req/s, "
+        f"{percentiles(latencies)}"
+    )
+
+    synced = {}
+    deadline = perf_counter() + 120
+    while len(synced) < len(joined) and perf_counter() < deadline:
+        now = perf_counter()
+        with server.lock:
+            for discord_id, at in joined.items():
+                if discord_id not in synced and role in server.roles.get(discord_id, ()):
+                    synced[discord_id] = now - at
+        sleep(0.01)
+    stop.set()
+    print(
+        f"sync:  {len(synced)}/{len(joined)} members have their role, "
+        f"{percentiles(list(synced.values()))} after the accept"
+    )
+    print(
+        f"discord: {server.patches - patches_before} "
+        f"role PATCHes, {server.rejected} 429s, {server.failed} 500s"
+    )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Latency of the Discord calls, a new connection per call vs the pooled session
+
+    python benchmarks/discord_client.py [iterations] [threads]
+
+Runs against benchmarks/mock_discord.py on localhost, so what's measured is
+the client side cost: connection setup, retries and requests overhead. Over
+TLS to discord.com the handshakes the pool saves cost a lot more.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from os.path import abspath, dirname
+from sys import argv, path
+from time import perf_counter
+
+path.insert(0, dirname(dirname(abspath(__file__))))
+path.insert(0, dirname(abspath(__file__)))
+
+import requests
+
+import discord_integrations
+import mock_discord
+from constants import DISCORD_BOT_TOKEN, GUILD_ID
+
+
+def legacy_set_roles(user_id, roles):
+    # what _set_roles did before the shared session
+    url = f"{discord_integrations.API_ENDPOINT}/guilds/{GUILD_ID}/members/{user_id}"
+    req = requests.patch(
+        url,
+        json={"roles": roles},
+        auth=discord_integrations.TokenAuth(DISCORD_BOT_TOKEN, "Bot"),
+    )
+    return req.ok
+
+
+def pooled_set_roles(user_id, roles):
+    return discord_integrations._set_roles(user_id, roles)
+
+
+def run(func, iterations: int, threads: int):
+    func("1", [])  # warm up
+    latencies = []
+
+    def call(i):
+        start = perf_counter()
+        func(str(i), [])
+        latencies.append(perf_counter() - start)
+
+    start = perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(call, range(iterations)))
+    total = perf_counter() - start
+    latencies.sort()
+    return (
+        iterations / total,
+        latencies[len(latencies) // 2] * 1e3,
+        latencies[int(len(latencies) * 0.99)] * 1e3,
+    )
+
+
+def main():
+    iterations = int(argv[1]) if len(argv) > 1 else 2000
+    threads = int(argv[2]) if len(argv) > 2 else 4
+    server = mock_discord.serve()
+    discord_integrations.API_ENDPOINT = mock_discord.endpoint(server)
+    print(f"{'client':<8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, func in (("legacy", legacy_set_roles), ("pooled", pooled_set_roles)):
+        rate, p50, p99 = run(func, iterations, threads)
+        print(f"{name:<8}{rate:>10.0f}{p50:>10.2f}{p99:>10.2f}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
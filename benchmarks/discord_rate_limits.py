@@ -0,0 +1,61 @@
+"""Role updates against a rate limited Discord stand-in
+
+    python benchmarks/discord_rate_limits.py [updates] [threads] [calls/second]
+
+Sends `updates` role PATCHes for different members from `threads` threads
+to benchmarks/mock_discord.py, whose member route allows `calls/second`.
+`naive` ignores the limits like the old client did, `bucketed` goes through
+discord_integrations. Shows how many updates were lost to 429s and how long
+the batch took.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from os.path import abspath, dirname
+from sys import argv, path
+from time import perf_counter, sleep
+
+path.insert(0, dirname(dirname(abspath(__file__))))
+path.insert(0, dirname(abspath(__file__)))
+
+import discord_integrations
+import mock_discord
+from constants import DISCORD_BOT_TOKEN, GUILD_ID
+
+
+def naive_set_roles(user_id, roles):
+    url = f"{discord_integrations.API_ENDPOINT}/guilds/{GUILD_ID}/members/{user_id}"
+    return discord_integrations.http().patch(
+        url,
+        json={"access_token": "access", "roles": roles},
+        auth=discord_integrations.TokenAuth(DISCORD_BOT_TOKEN, "Bot"),
+    ).ok
+
+
+def bucketed_set_roles(user_id, roles):
+    return discord_integrations._set_roles(user_id, roles)
+
+
+def main():
+    updates = int(argv[1]) if len(argv) > 1 else 50
+    threads = int(argv[2]) if len(argv) > 2 else 8
+    per_second = int(argv[3]) if len(argv) > 3 else 10
+    # a job worker would defer the update instead, here it just waits
+    discord_integrations.MAX_RATE_LIMIT_WAIT = 60
+    print(f"{'client':<10}{'sent':>6}{'applied':>9}{'429s':>6}{'seconds':>9}")
+    for name, func in (("naive", naive_set_roles), ("bucketed", bucketed_set_roles)):
+        server = mock_discord.serve(rate_limit=(per_second, 1.0))
+        discord_integrations.API_ENDPOINT = mock_discord.endpoint(server)
+        start = perf_counter()
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(lambda i: func(str(i), [str(i)]), range(updates)))
+        took = perf_counter() - start
+        print(
+            f"{name:<10}{updates:>6}{len(server.roles):>9}"
+            f"{server.rejected:>6}{took:>9.2f}"
+        )
+        server.shutdown()
+        server.server_close()
+        sleep(1)  # let the bucket state from this run expire
+
+
+if __name__ == "__main__":
+    main()
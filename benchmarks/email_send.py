@@ -0,0 +1,56 @@
+"""Sending emails to a local smtp sink, a connection per message vs the
+worker's shared connection
+
+    python benchmarks/email_send.py [messages] [latency]
+
+`latency` is the sink's delay per reply ( default 0.05s, a nearby mail
+server ). `legacy` is what every request used to do before answering:
+connect, EHLO, send, QUIT. `pooled` is email_manager._send as the worker
+runs it. STARTTLS and AUTH would add more round trips to every legacy send.
+"""
+from os import environ
+from os.path import abspath, dirname
+from smtplib import SMTP
+from sys import argv, path
+from time import perf_counter
+
+path.insert(0, dirname(dirname(abspath(__file__))))
+path.insert(0, dirname(abspath(__file__)))
+
+import mock_smtp
+
+
+def legacy_send(port, email, subject, content):
+    with SMTP("127.0.0.1", port) as smtp:
+        smtp.ehlo()
+        smtp.sendmail("bench@example.com", email, f"Subject: {subject}\n\n{content}")
+
+
+def main():
+    messages = int(argv[1]) if len(argv) > 1 else 50
+    latency = float(argv[2]) if len(argv) > 2 else 0.05
+    server = mock_smtp.serve(latency=latency)
+    port = server.server_address[1]
+    environ.update(MAIL_HOST="127.0.0.1", MAIL_PORT=str(port), MAIL_STARTTLS="0", MAIL_PASS="")
+
+    from api_handlers.email_manager import _send
+
+    print(f"{'client':<10}{'sent':>6}{'connects':>10}{'ms/mail':>9}")
+    for name, send in (
+        ("legacy", lambda *a: legacy_send(port, *a)),
+        ("pooled", _send),
+    ):
+        connections = server.connections
+        start = perf_counter()
+        for i in range(messages):
+            send(f"user{i}@example.com", "Email Verify - Qbytic", "bench")
+        took = perf_counter() - start
+        print(
+            f"{name:<10}{messages:>6}{server.connections - connections:>10}"
+            f"{took / messages * 1e3:>9.1f}"
+        )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
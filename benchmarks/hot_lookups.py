@@ -0,0 +1,82 @@
+"""Per-lookup Python overhead of the hot user/clan/config lookups
+
+    python benchmarks/hot_lookups.py [iterations]
+
+Runs against DATABASE_URL, picks an existing user, clan and event config and
+times the old Query-per-call lookups against the ones in api_handlers.common
+( baked queries for users and clans, config_cache for configs ). Time spent inside cursor.execute is measured separately
+and subtracted, what's left is SQLAlchemy/Python overhead.
+"""
+from os.path import abspath, dirname
+from sys import argv, path
+from time import perf_counter
+
+path.insert(0, dirname(dirname(abspath(__file__))))
+
+from sqlalchemy import event, func
+
+from app_init import EventConfig, TeamTable, UserTable, app, db
+from api_handlers.common import get_clan_by_id, get_config, get_user_by_id
+
+lower = func.lower
+_db_time = [0.0]
+
+
+def _before(conn, cursor, statement, parameters, context, executemany):
+    context._bench_start = perf_counter()
+
+
+def _after(conn, cursor, statement, parameters, context, executemany):
+    _db_time[0] += perf_counter() - context._bench_start
+
+
+# what get_user_by_id & co. did before the queries were baked
+def legacy_user(idx):
+    return UserTable.query.filter(lower(UserTable.user) == lower(idx)).first()
+
+
+def legacy_clan(idx):
+    return TeamTable.query.filter(lower(TeamTable.team_name) == lower(idx)).first()
+
+
+def legacy_config(name):
+    return EventConfig.query.filter_by(event_name=name).first()
+
+
+def run(func, arg, iterations):
+    func(arg)  # warm up ( and bake )
+    _db_time[0] = 0.0
+    start = perf_counter()
+    for _ in range(iterations):
+        func(arg)
+        db.session.expunge_all()
+    total = perf_counter() - start
+    return total / iterations * 1e6, (total - _db_time[0]) / iterations * 1e6
+
+
+def main():
+    iterations = int(argv[1]) if len(argv) > 1 else 2000
+    with app.app_context():
+        engine = db.engine
+        event.listen(engine, "before_cursor_execute", _before)
+        event.listen(engine, "after_cursor_execute", _after)
+        user = UserTable.query.first()
+        clan = TeamTable.query.first()
+        config = EventConfig.query.first()
+        cases = (
+            ("user", user and user.user, legacy_user, get_user_by_id),
+            ("clan", clan and clan.team_name, legacy_clan, get_clan_by_id),
+            ("config", config and config.event_name, legacy_config, get_config),
+        )
+        print(f"{'lookup':<8}{'variant':<8}{'total us':>10}{'python us':>11}")
+        for name, arg, legacy, baked in cases:
+            if arg is None:
+                print(f"{name:<8}no rows to look up, skipped")
+                continue
+            for variant, func in (("legacy", legacy), ("baked", baked)):
+                total, overhead = run(func, arg, iterations)
+                print(f"{name:<8}{variant:<8}{total:>10.1f}{overhead:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
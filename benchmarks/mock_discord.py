@@ -0,0 +1,216 @@
+"""Local stand-in for the parts of the Discord API discord_integrations uses
+
+    python benchmarks/mock_discord.py [--port 8765] [--latency 0.1]
+        [--failures 0.05] [--rate-limit 10/1]
+
+then start the app with DISCORD_API_ENDPOINT=http://127.0.0.1:8765/api/v6,
+or `serve()` it from a benchmark.
+
+- POST /oauth2/token: any code is accepted, a refresh token that starts with
+  "revoked" gets the 400 invalid_grant discord sends
+- GET /users/@me: a stable numeric id per code, see `discord_id`
+- PUT/PATCH/GET /guilds/<guild>/members[/<user>]: kept in memory
+- `latency` delays every response by 0.5x to 1.5x of it, `failures` is the
+  share of calls answered with a 500, `rate_limit=(calls, seconds)` gives
+  every route a Discord style bucket: X-RateLimit-* headers, and a 429 with
+  Retry-After once it's empty
+
+Speaks HTTP/1.1 so clients can keep their connections alive.
+"""
+from argparse import ArgumentParser
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from json import dumps, loads
+from math import ceil
+from random import random
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from time import sleep, time
+from urllib.parse import parse_qs, urlsplit
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    latency = 0.0
+    failures = 0.0
+    rate_limit = None
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lock = Lock()
+        self.buckets = {}
+        # what happened, for benchmarks to check
+        self.requests = 0
+        self.rejected = 0
+        self.failed = 0
+        self.patches = 0
+        self.roles = {}
+
+    def take(self, route: str) -> dict:
+        """Headers for a call on `route`, Retry-After in them if it's over the limit"""
+        calls, per = self.rate_limit
+        now = time()
+        with self.lock:
+            remaining, reset_at = self.buckets.get(route) or (calls, now + per)
+            if reset_at <= now:
+                remaining, reset_at = calls, now + per
+            if remaining == 0:
+                self.rejected += 1
+                # whole seconds in the header, like discord
+                return {
+                    "Retry-After": str(ceil(reset_at - now)),
+                    "X-RateLimit-Remaining": "0",
+                    "X-RateLimit-Reset-After": f"{reset_at - now:.3f}",
+                }
+            remaining -= 1
+            self.buckets[route] = remaining, reset_at
+        return {
+            "X-RateLimit-Bucket": route,
+            "X-RateLimit-Limit": str(calls),
+            "X-RateLimit-Remaining": str(remaining),
+            "X-RateLimit-Reset-After": f"{reset_at - now:.3f}",
+        }
+
+
+def discord_id(code: str) -> str:
+    """The id /users/@me reports for a user who linked with `code`"""
+    return str(int(md5(code.encode()).hexdigest()[:12], 16))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, without this keep-alive
+    # connections stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def _reply(self, status: int, body, headers: dict = None):
+        data = dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self) -> str:
+        # discord buckets member routes per guild, not per member
+        parts = urlsplit(self.path).path.split("/")
+        if "members" in parts:
+            parts = parts[: parts.index("members") + 1]
+        return f"{self.command} {'/'.join(parts)}"
+
+    def _handle(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            sleep(server.latency * (0.5 + random()))
+        headers = server.take(self._route()) if server.rate_limit else {}
+        if "Retry-After" in headers:
+            retry_after = float(headers["X-RateLimit-Reset-After"])
+            return self._reply(
+                429,
+                {"message": "You are being rate limited.", "retry_after": retry_after},
+                headers,
+            )
+        if random() < server.failures:
+            with server.lock:
+                server.failed += 1
+            return self._reply(500, {"message": "500: Internal Server Error"})
+        return self._respond(body, headers)
+
+    def _respond(self, body: bytes, headers: dict):
+        server = self.server
+        url = urlsplit(self.path)
+        if url.path.endswith("/oauth2/token"):
+            form = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+            code = form.get("code")
+            grant = code or form.get("refresh_token") or ""
+            if grant.startswith("revoked"):
+                return self._reply(400, {"error": "invalid_grant"}, headers)
+            # refresh tokens rotate on every refresh, like discord's
+            rotated = md5(f"{grant}:{time()}".encode()).hexdigest()
+            return self._reply(
+                200,
+                {
+                    "access_token": f"access-{code}" if code else f"access-{rotated}",
+                    "refresh_token": f"refresh-{rotated}",
+                    "expires_in": 604800,
+                    "token_type": "Bearer",
+                },
+                headers,
+            )
+        if url.path.endswith("/users/@me"):
+            token = self.headers.get("Authorization", "").split(" ")[-1]
+            if not token.startswith("access-"):
+                return self._reply(401, {"message": "401: Unauthorized"}, headers)
+            code = token[len("access-") :]
+            return self._reply(200, {"id": discord_id(code)}, headers)
+        if "/guilds/" in url.path and "/members/" in url.path:
+            member = url.path.rstrip("/").rsplit("/", 1)[1]
+            if self.command in ("PUT", "PATCH"):
+                with server.lock:
+                    server.patches += self.command == "PATCH"
+                    server.roles[member] = loads(body).get("roles") or []
+            return self._reply(200, {"user": {"id": member}}, headers)
+        if "/guilds/" in url.path and url.path.endswith("/members"):
+            query = parse_qs(url.query)
+            after = int(query.get("after", ["0"])[0])
+            limit = int(query.get("limit", ["1"])[0])
+            with server.lock:
+                ids = sorted(int(x) for x in server.roles if int(x) > after)
+                page = [
+                    {"user": {"id": str(x)}, "roles": server.roles[str(x)]}
+                    for x in ids[:limit]
+                ]
+            return self._reply(200, page, headers)
+        self._reply(404, {"message": "404: Not Found"})
+
+    do_GET = do_POST = do_PUT = do_PATCH = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(
+    port: int = 0,
+    latency: float = 0.0,
+    rate_limit: tuple = None,
+    failures: float = 0.0,
+) -> HTTPServer:
+    """Start the server on a background thread, port 0 picks a free one"""
+    server = _Server(("127.0.0.1", port), _Handler)
+    server.latency = latency
+    server.rate_limit = rate_limit
+    server.failures = failures
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def endpoint(server: HTTPServer) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}/api/v6"
+
+
+def rate_limit(value: str) -> tuple:
+    """"10/1" -> (10, 1.0), ten calls a second"""
+    calls, per = value.split("/")
+    return int(calls), float(per)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="local stand-in for the discord api")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--failures", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=rate_limit, default=None)
+    args = parser.parse_args()
+    server = serve(args.port, args.latency, args.rate_limit, args.failures)
+    print(f"mock discord on {endpoint(server)}")
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
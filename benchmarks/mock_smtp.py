@@ -0,0 +1,92 @@
+"""Local smtp sink, keeps what it receives in memory
+
+    python benchmarks/mock_smtp.py [--port 8025] [--latency 0.05]
+
+then run the worker with MAIL_HOST=127.0.0.1 MAIL_PORT=8025 MAIL_STARTTLS=0
+MAIL_PASS= , or `serve()` it from a benchmark. Every reply is delayed by
+`latency`, like the round trip to a real mail server. No STARTTLS or AUTH,
+addresses starting with "refused" get a 550.
+"""
+from argparse import ArgumentParser
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from threading import Lock, Thread
+from time import sleep
+
+
+class _Server(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    latency = 0.0
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lock = Lock()
+        self.connections = 0
+        # [(to, message), ...]
+        self.messages = []
+
+
+class _Handler(StreamRequestHandler):
+    def _reply(self, line: str):
+        if self.server.latency:
+            sleep(self.server.latency)
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self._reply("220 mock smtp ready")
+        recipients = []
+        for raw in self.rfile:
+            line = raw.decode().rstrip("\r\n")
+            command = line[:4].upper()
+            if command == "EHLO":
+                self._reply("250 mock")
+            elif command == "RCPT":
+                to = line.split(":", 1)[1].strip().strip("<>")
+                if to.startswith("refused"):
+                    self._reply("550 no such user")
+                    continue
+                recipients.append(to)
+                self._reply("250 ok")
+            elif command == "DATA":
+                self._reply("354 end with .")
+                lines = []
+                for data in self.rfile:
+                    if data in (b".\r\n", b".\n"):
+                        break
+                    lines.append(data.decode())
+                with server.lock:
+                    server.messages.extend((to, "".join(lines)) for to in recipients)
+                recipients = []
+                self._reply("250 queued")
+            elif command == "QUIT":
+                self._reply("221 bye")
+                return
+            else:
+                # MAIL, RSET, NOOP, HELO
+                recipients = [] if command in ("MAIL", "RSET") else recipients
+                self._reply("250 ok")
+
+
+def serve(port: int = 0, latency: float = 0.0) -> ThreadingTCPServer:
+    """Start the sink on a background thread, port 0 picks a free one"""
+    server = _Server(("127.0.0.1", port), _Handler)
+    server.latency = latency
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="local smtp sink")
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    server = serve(args.port, args.latency)
+    print(f"mock smtp on 127.0.0.1:{server.server_address[1]}")
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,40 @@
+"""Cost of the shared rate limiter per request
+
+    python benchmarks/rate_limit_check.py [checks] [ips]
+
+Runs rate_limit.check for `checks` requests spread over `ips` client
+addresses, the way gate_check does before every request, and reports the
+time per check. Uses the real shared_state table, so the flock and mmap
+access are in the number.
+"""
+from os.path import abspath, dirname
+from sys import argv, path
+from time import perf_counter
+
+path.insert(0, dirname(dirname(abspath(__file__))))
+
+import rate_limit
+
+
+class FakeRequest:
+    headers = {}
+    endpoint = "all_teams"
+
+    def __init__(self, ip):
+        self.remote_addr = ip
+
+
+def main():
+    checks = int(argv[1]) if len(argv) > 1 else 200_000
+    ips = int(argv[2]) if len(argv) > 2 else 10_000
+    requests = [FakeRequest(f"10.0.{i >> 8 & 255}.{i & 255}") for i in range(ips)]
+    limited = 0
+    start = perf_counter()
+    for i in range(checks):
+        limited += rate_limit.check(requests[i % ips]) > 0
+    took = perf_counter() - start
+    print(f"{checks} checks over {ips} ips: {took / checks * 1e6:.1f} us/check, {limited} limited")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Per-worker copy of the event_config table
+"""
+# Event configs change a couple of times per event but are read on every
+# score and clan join. Every worker keeps the whole table in memory and
+# LISTENs on a Postgres channel, whoever changes a config calls `notify` in
+# the same transaction and every worker, on every dyno, reloads once that
+# transaction commits.
+from os import getpid
+from select import select
+from threading import Lock, Thread
+from time import sleep
+
+from sqlalchemy import func
+from sqlalchemy import select as _select
+
+import metrics
+from app_init import EventConfig, db
+
+CHANNEL = "event_config"
+# reload anyway every so often, in case a notification got lost
+REFRESH_SECONDS = 300
+RECONNECT_SECONDS = 5
+
+_lock = Lock()
+_configs = {}
+_pid = None
+
+
+def _load():
+    global _configs
+    with db.engine.connect() as conn:
+        rows = conn.execute(EventConfig.__table__.select()).fetchall()
+    # swap the whole dict, readers never see a half loaded table
+    _configs = {x.event_name: x for x in rows}
+    metrics.inc("event_config_reloads")
+
+
+def _connect():
+    # a connection of its own, it never goes back to the pool
+    conn = db.engine.raw_connection()
+    conn.detach()
+    conn.connection.rollback()  # pool_pre_ping left a transaction open
+    conn.connection.autocommit = True
+    with conn.connection.cursor() as cursor:
+        cursor.execute(f"LISTEN {CHANNEL}")
+    return conn
+
+
+def _listen(conn):
+    while True:
+        try:
+            dbapi = conn.connection
+            ready, _, _ = select([dbapi], [], [], REFRESH_SECONDS)
+            if ready:
+                dbapi.poll()
+                dbapi.notifies.clear()
+            _load()
+        except Exception:
+            metrics.inc("event_config_listen_errors")
+            try:
+                conn.close()
+            except Exception:
+                pass
+            conn = _reconnect()
+
+
+def _reconnect():
+    while True:
+        sleep(RECONNECT_SECONDS)
+        try:
+            conn = _connect()
+            # whatever was sent while we were away
+            _load()
+            return conn
+        except Exception:
+            metrics.inc("event_config_listen_errors")
+
+
+def start():
+    """Load the table and start listening, once per process.
+    Called from gunicorn's post_worker_init, `get` calls it too
+    """
+    global _pid
+    if _pid == getpid():
+        return
+    with _lock:
+        if _pid == getpid():
+            return
+        # LISTEN before loading so a change can't slip in between the two
+        conn = _connect()
+        _load()
+        Thread(
+            target=_listen, args=(conn,), name="event-config-listener", daemon=True
+        ).start()
+        _pid = getpid()
+
+
+def get(name: str):
+    """
+    Returns:
+        row with event_name, number_of_rounds and config, or None
+    """
+    start()
+    return _configs.get(name)
+
+
+def notify(name: str):
+    # delivered when the current transaction commits, not before
+    db.session.execute(_select([func.pg_notify(CHANNEL, name)]))
@@ -15,6 +15,13 @@ DISCORD_BOT_TOKEN = _environ["DISCORD_BOT_TOKEN"]
 PARTICIPANT_ROLE_ID = _environ["DISCORD_PARTICIPANT_ROLE"]
 
 GUILD_ID = _environ["DISCORD_GUILD_ID"]
+# point it at benchmarks/mock_discord.py to load test without discord
+DISCORD_API_ENDPOINT = _environ.get(
+    "DISCORD_API_ENDPOINT", "https://discord.com/api/v6"
+)
+# seconds to wait for a connection / a response from the discord api
+DISCORD_CONNECT_TIMEOUT = float(_environ.get("DISCORD_CONNECT_TIMEOUT", 3.05))
+DISCORD_READ_TIMEOUT = float(_environ.get("DISCORD_READ_TIMEOUT", 10))
 
 ALLOW_REMOVALS = _environ.get("NO_REMOVE") is None
 # JWT Signing key, make sure this stays same or every user will need to relogin
@@ -22,6 +29,24 @@ SIGNING_KEY = _environ.get("JWT_SIGNING_KEY")
 # How long an access_token will last
 TOKEN_EXPIRATION_TIME_IN_SECONDS = 60 * int(_environ.get("TOKEN_EXPIRATION_TIME"))
 
+# gunicorn worker layout ( gunicorn.conf.py reads the same variables )
+WEB_WORKERS = int(_environ.get("WEB_WORKERS", 4))
+WEB_THREADS = int(_environ.get("WEB_THREADS", 4))
+# connections this dyno may open to postgres, split between its workers
+DB_MAX_CONNECTIONS = int(_environ.get("DB_MAX_CONNECTIONS", 20))
+# abort any single statement that runs longer than this
+DB_STATEMENT_TIMEOUT_MS = int(_environ.get("DB_STATEMENT_TIMEOUT_MS", 5000))
+# after a write, the user's reads skip the read replica for this long
+READ_YOUR_WRITES_SECONDS = int(_environ.get("READ_YOUR_WRITES_SECONDS", 5))
+# background jobs ( worker.py ), a job is dead-lettered after this many tries
+JOB_MAX_ATTEMPTS = int(_environ.get("JOB_MAX_ATTEMPTS", 8))
+JOB_POLL_SECONDS = float(_environ.get("JOB_POLL_SECONDS", 1))
+# bearer token prometheus scrapes /admin/metrics/prometheus/ with, admin
+# access tokens work too
+METRICS_TOKEN = _environ.get("METRICS_TOKEN")
+# a request sent with `x-trace: <TRACE_TOKEN>` is always traced
+TRACE_TOKEN = _environ.get("TRACE_TOKEN")
+
 EVENT_NAMES = ("gaming", "prog", "pentest", "lit", "music", "video", "minihalo")
 ROLE_ID_DICT = dict(
     zip(
@@ -47,6 +72,16 @@ EVENTS_REQUIRING_SUBMISSION = _remove_from(EVENT_NAMES, ("gaming", "minihalo"))
 
 MAIL_USERNAME = _environ["MAIL_USER"]
 MAIL_PASS = _environ["MAIL_PASS"]
+# MAIL_STARTTLS=0 and an empty MAIL_PASS for a plain local smtp sink
+MAIL_HOST = _environ.get("MAIL_HOST", "smtp.gmail.com")
+MAIL_PORT = int(_environ.get("MAIL_PORT", 587))
+MAIL_STARTTLS = _environ.get("MAIL_STARTTLS", "1") != "0"
+MAIL_TIMEOUT = float(_environ.get("MAIL_TIMEOUT", 10))
+# verification / reset emails per account: none within MAIL_RESEND_SECONDS
+# of the last one, at most MAIL_MAX_PER_WINDOW per MAIL_WINDOW_SECONDS
+MAIL_RESEND_SECONDS = int(_environ.get("MAIL_RESEND_SECONDS", 60))
+MAIL_MAX_PER_WINDOW = int(_environ.get("MAIL_MAX_PER_WINDOW", 5))
+MAIL_WINDOW_SECONDS = int(_environ.get("MAIL_WINDOW_SECONDS", 60 * 60))
 
 del _remove_from
 del _environ
@@ -14,6 +14,7 @@ from constants import (
     SIGNING_KEY as _SIGNING_KEY,
     TOKEN_EXPIRATION_TIME_IN_SECONDS as _TOKEN_EXPIRATION_TIME_IN_SECONDS,
 )
+from tracing import traced as _traced
 from util import AppException
 
 if _SIGNING_KEY is None:
@@ -30,10 +31,12 @@ _decode_token = _jwt.decode
 
 # =======================================================================
 #                       Password Hashing
+@_traced("check_password_hash")
 def check_password_hash(_hash: str, pw: str) -> bool:
     return _hash_method.verify(pw, _hash)
 
 
+@_traced("generate_password_hash")
 def generate_password_hash(pw):
     return _hash_method.hash(pw)
 
@@ -57,6 +60,7 @@ def create_token(data: dict) -> str:
     return _encode_token(data, _SIGNING_KEY).decode()
 
 
+@_traced("decode_token")
 def decode_token(data: str) -> dict:
     try:
         return _decode_token(data, _SIGNING_KEY)
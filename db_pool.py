@@ -0,0 +1,110 @@
+"""SQLAlchemy pool sizing and instrumentation for the gunicorn workers
+"""
+from time import perf_counter
+
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+
+import metrics
+import query_log
+import tracing
+from constants import (
+    DB_MAX_CONNECTIONS,
+    DB_STATEMENT_TIMEOUT_MS,
+    WEB_THREADS,
+    WEB_WORKERS,
+)
+
+# seconds a thread waits for a free connection before the request fails
+POOL_TIMEOUT = 10
+# drop connections older than this, heroku (and pgbouncer) close idle ones
+POOL_RECYCLE = 300
+
+
+class InstrumentedQueuePool(QueuePool):
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeout:
+            metrics.inc("db_pool_checkout_timeouts")
+            raise
+        finally:
+            metrics.observe("db_pool_checkout_wait_seconds", perf_counter() - start)
+            self._report()
+
+    def _do_return_conn(self, conn):
+        super()._do_return_conn(conn)
+        self._report()
+
+    def _report(self):
+        metrics.set_gauge("db_pool_checked_out", self.checkedout())
+        metrics.set_gauge("db_pool_overflow", max(self.overflow(), 0))
+
+
+@event.listens_for(InstrumentedQueuePool, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    metrics.inc("db_pool_connects")
+
+
+@event.listens_for(InstrumentedQueuePool, "invalidate")
+def _on_invalidate(dbapi_connection, connection_record, exception):
+    metrics.inc("db_pool_invalidations")
+
+
+# every statement's time, and per request how many ran and how long they
+# took ( g.sql = [count, seconds] ) and which ones ( g.sql_log, see
+# query_log.py ), reported by app_init.record_request
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    # kept on the statement's execution context, which goes away with it
+    # when the statement raises and after_cursor_execute never runs
+    if context is not None:
+        context._query_start = perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_query_start", None)
+    if started is None:
+        return
+    took = perf_counter() - started
+    metrics.histogram("sql_statement_seconds", took)
+    if has_request_context() and "sql" in g:
+        g.sql[0] += 1
+        g.sql[1] += took
+        if g.sql_log is not None:
+            query_log.record(g.sql_log, statement, took)
+    if tracing.active():
+        tracing.record("sql", started, took, statement=query_log.short(statement))
+
+
+def engine_options() -> dict:
+    # every thread of a worker can hold a connection, anything the connection
+    # budget leaves on top of that becomes overflow. One connection per worker
+    # is kept for config_cache's listener
+    per_worker = max(DB_MAX_CONNECTIONS // WEB_WORKERS - 1, 1)
+    pool_size = min(WEB_THREADS, per_worker)
+    metrics.set_gauge("db_pool_size", pool_size)
+    metrics.set_gauge("db_pool_max_overflow", per_worker - pool_size)
+    return {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": pool_size,
+        "max_overflow": per_worker - pool_size,
+        "pool_timeout": POOL_TIMEOUT,
+        "pool_recycle": POOL_RECYCLE,
+        "pool_pre_ping": True,
+        "connect_args": {
+            "options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+        },
+    }
+
+
+def warm_up(engine):
+    pool = engine.pool
+    connections = [pool.connect() for _ in range(pool.size())]
+    for conn in connections:
+        conn.close()
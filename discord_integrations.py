@@ -1,26 +1,212 @@
-from time import time
+from os import getpid
+from threading import Lock
+from time import perf_counter, sleep, time
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from constants import (
+    DISCORD_API_ENDPOINT,
     DISCORD_BOT_TOKEN,
     DISCORD_CLIENT_ID,
+    DISCORD_CONNECT_TIMEOUT,
+    DISCORD_READ_TIMEOUT,
     DISCORD_SECRET,
     GUILD_ID,
     IS_HEROKU,
     PARTICIPANT_ROLE_ID,
+    WEB_THREADS,
 )
+import metrics
+import tracing
+import shared_state
 from util import AppException
 
 # from api_handlers.common import save_to_db
 
 APP_SCOPE = "identify guilds.join"
-API_ENDPOINT = "https://discord.com/api/v6"
+API_ENDPOINT = DISCORD_API_ENDPOINT
 _URI = "https://qbytic.com" if IS_HEROKU else "http://localhost:4200"
 
 REDIRECT_URI = f"{_URI}/u/-/discord/auth/flow/signup"
 
 
+# connections to discord are kept alive and shared by the threads of a
+# process, instead of a TCP + TLS handshake for every call
+_RETRIES = dict(
+    total=2,
+    backoff_factor=0.3,
+    status_forcelist=(500, 502, 503, 504),
+    raise_on_status=False,
+    # 429s are handled with the rate limit buckets below
+    respect_retry_after_header=False,
+)
+# the oauth POSTs are not retried, a code can only be exchanged once
+_RETRY_METHODS = frozenset(("GET", "PUT", "PATCH"))
+try:
+    _retry = Retry(**_RETRIES, allowed_methods=_RETRY_METHODS)
+except TypeError:  # urllib3 < 1.26
+    _retry = Retry(**_RETRIES, method_whitelist=_RETRY_METHODS)
+
+
+class _Adapter(HTTPAdapter):
+    def send(self, request, timeout=None, **kwargs):
+        # requests waits forever unless told otherwise
+        timeout = timeout or (DISCORD_CONNECT_TIMEOUT, DISCORD_READ_TIMEOUT)
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+_session = None
+_session_pid = None
+_session_lock = Lock()
+
+
+def http() -> requests.Session:
+    """The process' shared session, a new one after a fork"""
+    global _session, _session_pid
+    if _session_pid != getpid():
+        with _session_lock:
+            if _session_pid != getpid():
+                session = requests.Session()
+                adapter = _Adapter(pool_maxsize=WEB_THREADS, max_retries=_retry)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session, _session_pid = session, getpid()
+    return _session
+
+
+# Discord rate limits every method and route ( per major parameter, the
+# guild here ) and the bot as a whole. What's left of a bot route's bucket and when it resets
+# is read from the X-RateLimit-* headers and kept in shared_state, so every
+# worker of a dyno waits its turn instead of burning the bucket into 429s.
+# The oauth2 and users/@me calls are limited per user token, one user's
+# signup says nothing about the next one's, so those are only held back by
+# the global limit and wait out their own 429s.
+# A call that would wait longer than `max_wait` raises RateLimited.
+MAX_RATE_LIMIT_WAIT = 2
+_GLOBAL = "discord:global"
+_PROBING = -1
+_PROBE = 1
+_UNLIMITED = float("inf")
+
+
+def _bucketed(route: str) -> bool:
+    # the routes called with the bot token
+    return route.startswith("guilds/")
+
+
+def _bucket(method: str, route: str) -> str:
+    # listing the members and patching one are limited separately
+    return f"discord:{method} {route}"
+
+
+class RateLimited(AppException):
+    retryable = True
+
+    def __init__(self, retry_after: float):
+        super().__init__("Discord is busy right now, try again in a bit")
+        self.retry_after = retry_after
+
+
+def _reserve(method: str, route: str) -> float:
+    """Take a call from the route's bucket
+
+    Returns:
+        float: 0, or seconds until the bucket has room again
+    """
+    now = time()
+    blocked = shared_state.get(_GLOBAL)
+    if blocked is not None and blocked[1] > now:
+        return blocked[1] - now
+    if not _bucketed(route):
+        return 0
+    wait = [0.0]
+
+    def take(bucket):
+        if bucket is None or bucket[1] <= now:
+            # unknown or reset: one call goes first and its response fills in
+            # the bucket, the rest wait for that ( or at most _PROBE seconds )
+            return _PROBING, now + _PROBE
+        remaining, reset_at = bucket
+        if remaining >= 1:
+            return remaining - 1, reset_at
+        # a probe usually answers well before it times out, look again soon
+        wait[0] = min(reset_at - now, 0.05) if remaining == _PROBING else reset_at - now
+        return bucket
+
+    shared_state.update(_bucket(method, route), take, ttl=60)
+    return wait[0]
+
+
+def _record(method: str, route: str, response: requests.Response):
+    now = time()
+    headers = response.headers
+    if response.status_code == 429:
+        is_global = headers.get("X-RateLimit-Global")
+        # Retry-After is rounded up to whole seconds, Reset-After is exact
+        retry_after = float(
+            (not is_global and headers.get("X-RateLimit-Reset-After"))
+            or headers.get("Retry-After")
+            or 1
+        )
+        if is_global or _bucketed(route):
+            key = _GLOBAL if is_global else _bucket(method, route)
+            shared_state.put(key, 0, now + retry_after, ttl=retry_after + 1)
+        metrics.inc("discord_rate_limited")
+        return retry_after
+    if not _bucketed(route):
+        return 0
+    remaining = headers.get("X-RateLimit-Remaining")
+    reset_after = headers.get("X-RateLimit-Reset-After")
+    if remaining is None or reset_after is None:
+        # no limit reported, let everyone through until the next probe
+        shared_state.put(_bucket(method, route), _UNLIMITED, now + _PROBE, ttl=_PROBE + 1)
+        return 0
+    remaining, reset_at = float(remaining), now + float(reset_after)
+
+    def merge(bucket):
+        # responses of calls sent before ours can report more room than
+        # we have already handed out, never raise the count within a window
+        if bucket is not None and bucket[0] != _PROBING and bucket[1] > now:
+            return min(bucket[0], remaining), bucket[1]
+        return remaining, reset_at
+
+    shared_state.update(_bucket(method, route), merge, ttl=float(reset_after) + 1)
+    return 0
+
+
+def _request(method: str, route: str, url: str, max_wait: float = None, **kwargs):
+    deadline = time() + (MAX_RATE_LIMIT_WAIT if max_wait is None else max_wait)
+    retry_after = 0
+    for _ in range(3):
+        wait = _reserve(method, route)
+        while wait:
+            if time() + wait > deadline:
+                raise RateLimited(wait)
+            metrics.observe("discord_rate_limit_wait_seconds", wait)
+            sleep(wait)
+            wait = _reserve(method, route)
+        start = perf_counter()
+        with tracing.span("discord", method=method, route=route):
+            response = http().request(method, url, **kwargs)
+        took = perf_counter() - start
+        metrics.histogram("discord_http_seconds", took, route=route, status=response.status_code)
+        retry_after = _record(method, route, response)
+        if not retry_after:
+            return response
+        if not _bucketed(route):
+            # nothing shared to wait on, sit out this token's own limit
+            if time() + retry_after > deadline:
+                raise RateLimited(retry_after)
+            sleep(retry_after)
+    raise RateLimited(retry_after)
+
+
+class GrantRevoked(AppException):
+    """Discord refused the code or refresh token, the user has to link again"""
+
+
 class TokenAuth(requests.auth.AuthBase):
     def __init__(self, token, auth_type="Bearer"):
         self.token = token
@@ -32,10 +218,12 @@ class TokenAuth(requests.auth.AuthBase):
 
 
 def ensure_fresh_token(func):
+    # tasks.refresh_tokens renews tokens before they expire,
+    # this is the fallback for one it didn't get to in time
     def wrapper(*args):
         user_data = args[0]
         expires_in = user_data.discord_token_expires_in
-        if time() >= expires_in:
+        if user_data.discord_refresh_token and time() >= (expires_in or 0):
             data = refresh_token(user_data.discord_refresh_token)
             user_data.discord_access_token = data["access"]
             user_data.discord_refresh_token = data["refresh"]
@@ -46,11 +234,13 @@ def ensure_fresh_token(func):
 
 
 def _post_to_discord(data):
-    r = requests.post(f"{API_ENDPOINT}/oauth2/token", data=data)
+    r = _request("POST", "oauth2/token", f"{API_ENDPOINT}/oauth2/token", data=data)
 
     if not r.ok:
         print(r.text)
         # return
+        if r.status_code in (400, 401):
+            raise GrantRevoked("Discord api gave invalid response")
         raise AppException("Discord api gave invalid response")
     js = r.json()
     return {
@@ -87,7 +277,9 @@ def refresh_token(refresh_token: str) -> dict:
 
 def query_user(data: dict) -> dict:
     access = data["access"]
-    req = requests.get(f"{API_ENDPOINT}/users/@me", auth=TokenAuth(access))
+    req = _request(
+        "GET", "users/@me", f"{API_ENDPOINT}/users/@me", auth=TokenAuth(access)
+    )
     js = req.json()
     if not req.ok:
         print(js)
@@ -105,7 +297,9 @@ def add_to_guild(user_data):
 
 def _add_to_guild(user_id, access):
     url = f"{API_ENDPOINT}/guilds/{GUILD_ID}/members/{user_id}"
-    req = requests.put(
+    req = _request(
+        "PUT",
+        f"guilds/{GUILD_ID}/members",
         url,
         json={"access_token": access, "roles": [PARTICIPANT_ROLE_ID]},
         auth=TokenAuth(DISCORD_BOT_TOKEN, "Bot"),
@@ -113,19 +307,53 @@ def _add_to_guild(user_id, access):
     return _assert_success(req)
 
 
-@ensure_fresh_token
 def set_roles(user_data, roles: list):
-    user_id = user_data.discord_id
-    access = user_data.discord_access_token
-    return _set_roles(user_id, access, roles)
+    return _set_roles(user_data.discord_id, roles)
 
 
-def _set_roles(user_id, access, roles):
-    url = f"{API_ENDPOINT}/guilds/{GUILD_ID}/members/{user_id}"
+def _set_roles(user_id, roles):
+    # editing a member only needs the bot token, the user's own token is for
+    # adding them, so there's nothing to refresh here
     roles.append(PARTICIPANT_ROLE_ID)
-    req = requests.patch(
-        url,
-        json={"access_token": access, "roles": roles},
+    return patch_member_roles(user_id, roles)
+
+
+MEMBERS_PAGE = 1000
+
+
+def guild_members(max_wait: float = None):
+    """Every member of the guild, one page of MEMBERS_PAGE per request
+
+    Yields:
+        dict: discord's guild member object, `user.id` and `roles` among others
+    """
+    after = "0"
+    while True:
+        req = _request(
+            "GET",
+            f"guilds/{GUILD_ID}/members",
+            f"{API_ENDPOINT}/guilds/{GUILD_ID}/members",
+            max_wait=max_wait,
+            params={"limit": MEMBERS_PAGE, "after": after},
+            auth=TokenAuth(DISCORD_BOT_TOKEN, "Bot"),
+        )
+        if not req.ok:
+            raise AppException(f"Could not list guild members: {req.status_code}")
+        page = req.json()
+        yield from page
+        if len(page) < MEMBERS_PAGE:
+            return
+        after = page[-1]["user"]["id"]
+
+
+def patch_member_roles(user_id, roles: list, max_wait: float = None) -> bool:
+    """Replace a member's roles with exactly `roles`, no token needed"""
+    req = _request(
+        "PATCH",
+        f"guilds/{GUILD_ID}/members",
+        f"{API_ENDPOINT}/guilds/{GUILD_ID}/members/{user_id}",
+        max_wait=max_wait,
+        json={"roles": roles},
         auth=TokenAuth(DISCORD_BOT_TOKEN, "Bot"),
     )
     return _assert_success(req)
@@ -1,3 +1,6 @@
+from os import environ
+
+
 def when_ready(server):
     # touch app-initialized when ready
     try:
@@ -6,9 +9,28 @@ def when_ready(server):
         pass
 
 
+def post_worker_init(worker):
+    # open the pool's connections before the first request instead of
+    # making the first few requests after every max_requests restart pay for it
+    try:
+        from app_init import warm_up_pool
+
+        warm_up_pool()
+    except Exception as e:
+        worker.log.warning(f"could not warm up the database pool: {e}")
+    try:
+        import config_cache
+
+        config_cache.start()
+    except Exception as e:
+        worker.log.warning(f"could not load the event configs: {e}")
+
+
 bind = "unix:///tmp/nginx.socket"
-workers = 4
-threads = 4
+# keep these in sync with WEB_WORKERS / WEB_THREADS in constants.py,
+# the database pool is sized from them
+workers = int(environ.get("WEB_WORKERS", 4))
+threads = int(environ.get("WEB_THREADS", 4))
 max_requests = 1200
 max_requests_jitter = 10
 timeout = 500
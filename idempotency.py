@@ -0,0 +1,169 @@
+"""Idempotency-Key support for POST routes, used by util.api_response
+"""
+# A client that retries a POST with the same Idempotency-Key header gets the
+# first response back instead of having the handler run again. Keys are
+# scoped to the caller's access token ( or "anon" for routes like register )
+# and the path, so one client's key never replays another's response. A
+# retry has to send the same body, one that doesn't gets a 422: the key was
+# reused for a different request. Responses that hand out credentials, like
+# login's tokens, are never saved, those requests just run again.
+#
+# shared_state holds a marker per key: IN_FLIGHT while the first request
+# runs, DONE once its response is saved to the @cache directory. A duplicate
+# that arrives while the first is running waits for it. Like shared_state
+# this is per dyno, a retry routed to another dyno runs the handler.
+# Saved responses are removed once a read finds them expired, and every
+# worker sweeps the ones nobody asked for again at most once per TTL.
+from hashlib import blake2b
+from json import dumps, loads
+from os import getpid, replace
+from pathlib import Path
+from time import sleep, time
+
+from flask import Response, request
+
+import shared_state
+
+# seconds a response is replayed for
+TTL = 10 * 60
+# how long a duplicate waits for the original, and how long an in flight
+# marker outlives a worker that died holding it
+WAIT = 20
+IN_FLIGHT_TTL = 120
+_POLL = 0.05
+
+CACHE_DIR = "@cache"
+_CREDENTIAL_HEADERS = ("x-access-token", "x-refresh-token")
+
+_last_sweep = 0.0
+
+_IN_FLIGHT = 1
+_DONE = 2
+
+
+def _scope(key: str) -> str:
+    caller = request.headers.get("x-access-token") or "anon"
+    return blake2b(f"{caller}\n{request.path}\n{key}".encode(), digest_size=16).hexdigest()
+
+
+def _body_hash() -> str:
+    return blake2b(request.get_data(), digest_size=16).hexdigest()
+
+
+def _error(status: int, message: str) -> Response:
+    return Response(dumps({"error": message}), status=status, content_type="application/json")
+
+
+def _path(scope: str) -> Path:
+    return Path(CACHE_DIR, f"idem-{scope}.json")
+
+
+def _save(scope: str, body_hash: str, response: Response):
+    Path(CACHE_DIR).mkdir(exist_ok=True)
+    data = dumps(
+        {
+            "time_stamp": time(),
+            "request": body_hash,
+            "status": response.status_code,
+            "body": response.get_data(as_text=True),
+        }
+    )
+    # written aside and renamed, a reader never sees half a file
+    path = _path(scope)
+    tmp = path.with_name(f"{path.name}.{getpid()}")
+    tmp.write_text(data)
+    replace(tmp, path)
+    _sweep()
+
+
+def _sweep():
+    global _last_sweep
+    now = time()
+    if now - _last_sweep < TTL:
+        return
+    _last_sweep = now
+    # leftover temp files of a worker that died mid write match too
+    for path in Path(CACHE_DIR).glob("idem-*"):
+        try:
+            if now - path.stat().st_mtime > TTL:
+                path.unlink()
+        except OSError:
+            pass
+
+
+def _load(scope: str, body_hash: str):
+    try:
+        data = loads(_path(scope).read_text())
+    except (OSError, ValueError):
+        return None
+    if time() - data["time_stamp"] > TTL:
+        try:
+            _path(scope).unlink()
+        except OSError:
+            pass
+        return None
+    if data.get("request") != body_hash:
+        return _error(422, "This Idempotency-Key was used for a different request")
+    response = Response(data["body"], status=data["status"], content_type="application/json")
+    response.headers["x-idempotent-replay"] = "1"
+    return response
+
+
+def run(key: str, produce) -> Response:
+    """The response for this `key`: the saved one, the one a concurrent
+    duplicate is producing, or a new one from `produce()`
+
+    Args:
+        produce (callable): returns (response, keep), keep is False for
+            responses a retry should not get, like unexpected errors
+    """
+    return _run(_scope(key), _body_hash(), produce)
+
+
+def _run(scope: str, body_hash: str, produce) -> Response:
+    marker = f"idem:{scope}"
+    if shared_state.get(marker) is not None:
+        return _replay(scope, body_hash, marker, produce)
+    now = time()
+
+    def claim(current):
+        if current is None:
+            return _IN_FLIGHT, now
+        return current
+
+    _, started = shared_state.update(marker, claim, ttl=IN_FLIGHT_TTL)
+    if started != now:
+        return _replay(scope, body_hash, marker, produce)
+    try:
+        response, keep = produce()
+    except BaseException:
+        shared_state.delete(marker)
+        raise
+    if keep and not any(h in response.headers for h in _CREDENTIAL_HEADERS):
+        _save(scope, body_hash, response)
+        shared_state.put(marker, _DONE, now, ttl=TTL)
+    else:
+        shared_state.delete(marker)
+    return response
+
+
+def _replay(scope: str, body_hash: str, marker: str, produce) -> Response:
+    deadline = time() + WAIT
+    while True:
+        value = shared_state.get(marker)
+        if value is None:
+            # the original failed, its response isn't kept: run it now
+            return _run(scope, body_hash, produce)
+        if value[0] == _DONE:
+            response = _load(scope, body_hash)
+            if response is not None:
+                return response
+            # the file is gone, the marker is no use without it
+            shared_state.delete(marker)
+            return _run(scope, body_hash, produce)
+        if time() > deadline:
+            response = _error(409, "A request with this Idempotency-Key is still running")
+            response.headers["Retry-After"] = "1"
+            return response
+        sleep(_POLL)
+
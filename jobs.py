@@ -0,0 +1,198 @@
+"""Postgres backed background jobs
+"""
+# `enqueue` writes the job in the current transaction, so a job exists
+# exactly when the transaction that asked for it commits: no saved change
+# without its job and no job for a change that was rolled back.
+#
+# worker.py claims due jobs with FOR UPDATE SKIP LOCKED, any number of
+# workers can poll side by side. Claiming marks the job running with a
+# lease and commits, the handler then runs in a transaction of its own that
+# also deletes the job. If the worker dies halfway the lease runs out and
+# the job runs again, so handlers have to be safe to repeat.
+from random import random
+from time import perf_counter, time
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+
+import metrics
+import tracing
+from app_init import Job, db
+from constants import JOB_MAX_ATTEMPTS
+
+# seconds before the first retry, doubled on every further failure
+BACKOFF_BASE = 5
+BACKOFF_MAX = 60 * 60
+# a running job whose worker went quiet this long is run again
+LEASE_SECONDS = 5 * 60
+
+_handlers = {}
+
+
+class JobFailed(Exception):
+    """Raise from a handler to have the job retried later"""
+
+
+class Deferred(Exception):
+    """Raise from a handler to run the job again in `delay` seconds,
+    without counting it as a failed attempt
+    """
+
+    def __init__(self, delay: float):
+        super().__init__(f"deferred for {delay:.1f}s")
+        self.delay = delay
+
+
+def handler(kind: str, lease: float = LEASE_SECONDS):
+    """Register `func(payload: dict)` as the handler for jobs of `kind`,
+    jobs that can take longer than LEASE_SECONDS need a longer `lease`
+    """
+
+    def decorator(func):
+        _handlers[kind] = func, lease
+        return func
+
+    return decorator
+
+
+def enqueue(kind: str, payload: dict, delay: float = 0, dedupe_key: str = None):
+    """Add a job to the current transaction
+
+    Args:
+        dedupe_key (str, optional): while a job with this key is waiting to
+            run no second one is added ( it is moved up if it was due later ),
+            for jobs that read the latest state when they run anyway
+    """
+    metrics.inc("jobs_enqueued")
+    trace = tracing.context()
+    if trace is not None:
+        # the job's trace continues this one, see run_one
+        payload = dict(payload, _trace=trace)
+    job = Job(kind, payload, time() + delay, dedupe_key)
+    if dedupe_key is None:
+        db.session.add(job)
+        return
+    table = Job.__table__
+    values = {c.name: getattr(job, c.name) for c in table.columns if c.name != "id"}
+    stmt = insert(table).values(**values)
+    db.session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[table.c.dedupe_key],
+            index_where=table.c.status == Job.PENDING,
+            set_={"run_at": func.least(table.c.run_at, stmt.excluded.run_at)},
+        )
+    )
+
+
+def _backoff(attempts: int) -> float:
+    delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    # jitter, jobs that failed together shouldn't all retry together
+    return delay * (0.5 + random() / 2)
+
+
+def _claim():
+    session = db.session
+    now = time()
+    job = (
+        Job.query.filter(Job.status != Job.DEAD, Job.run_at <= now)
+        .order_by(Job.run_at)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if job is None:
+        session.rollback()
+        return None
+    if job.status == Job.RUNNING and job.attempts >= JOB_MAX_ATTEMPTS:
+        # its lease ran out on the last try, the worker died running it
+        job.status = Job.DEAD
+        job.last_error = "Worker stopped while running the job"
+        metrics.inc("jobs_dead")
+        session.commit()
+        return _claim()
+    # counted when claimed, a job that kills its worker still runs out of tries
+    job.attempts += 1
+    job.status = Job.RUNNING
+    job.run_at = now + _handlers.get(job.kind, (None, LEASE_SECONDS))[1]
+    claimed = job.id, job.kind, job.payload
+    session.commit()
+    return claimed
+
+
+def run_one() -> bool:
+    """Run the next due job
+
+    Returns:
+        bool: False if there was nothing to run
+    """
+    claimed = _claim()
+    if claimed is None:
+        return False
+    job_id, kind, payload = claimed
+    tracing.start(f"job:{kind}", context=payload.pop("_trace", None))
+
+    session = db.session
+    start = perf_counter()
+    try:
+        if kind not in _handlers:
+            raise JobFailed(f"No handler for {kind}")
+        _handlers[kind][0](payload)
+        Job.query.filter_by(id=job_id).delete(synchronize_session=False)
+        session.commit()
+        metrics.inc("jobs_done")
+    except Exception as e:
+        session.rollback()
+        _reschedule(job_id, e)
+    finally:
+        metrics.observe(f"job_{kind}_seconds", perf_counter() - start)
+        tracing.finish(job_id=job_id)
+    return True
+
+
+def _reschedule(job_id: int, error: Exception):
+    session = db.session
+    job = Job.query.filter_by(id=job_id).with_for_update().first()
+    if job is None:
+        session.rollback()
+        return
+    now = time()
+    job.status = Job.PENDING
+    if isinstance(error, Deferred):
+        job.attempts -= 1
+        job.run_at = now + error.delay
+        metrics.inc("jobs_deferred")
+    else:
+        job.last_error = f"{type(error).__name__}: {error}"[:2000]
+        if job.attempts >= JOB_MAX_ATTEMPTS:
+            job.status = Job.DEAD
+            metrics.inc("jobs_dead")
+            print(f"job {job.id} ({job.kind}) is dead: {job.last_error}")
+        else:
+            job.run_at = now + _backoff(job.attempts)
+            metrics.inc("jobs_retried")
+    try:
+        session.commit()
+    except IntegrityError:
+        # a newer job with the same dedupe_key is already waiting
+        session.rollback()
+        Job.query.filter_by(id=job_id).delete(synchronize_session=False)
+        session.commit()
+
+
+def retry_dead() -> int:
+    """Put dead-lettered jobs back in the queue, returns how many"""
+    waiting = Job.query.filter(Job.status == Job.PENDING, Job.dedupe_key.isnot(None))
+    pending = {x.dedupe_key for x in waiting}
+    count = 0
+    for job in Job.query.filter(Job.status == Job.DEAD).order_by(Job.id.desc()):
+        if job.dedupe_key is not None:
+            if job.dedupe_key in pending:
+                db.session.delete(job)
+                continue
+            pending.add(job.dedupe_key)
+        job.status = Job.PENDING
+        job.attempts = 0
+        job.run_at = time()
+        count += 1
+    db.session.commit()
+    return count
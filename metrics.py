@@ -0,0 +1,243 @@
+"""Process local counters, gauges, timing summaries and histograms
+"""
+# each gunicorn worker keeps its own numbers, the admin metrics route reports
+# the worker that served it along with its pid.
+#
+# For prometheus every worker also writes its snapshot to DIR/<pid>.json
+# ( `flush`, at most every FLUSH_SECONDS, after requests ). `collect` reads
+# the files of the workers still alive and `prometheus` adds them up:
+# counters, summaries and histograms are summed, gauges keep a pid label.
+# A worker restarted by max_requests starts from zero, prometheus' rate()
+# treats that as a counter reset.
+#
+# The job worker runs on its own dyno, which gets no HTTP traffic. It saves
+# its snapshot to the worker_metrics table instead ( worker.save_metrics )
+# and /admin/metrics/prometheus/ on the web dynos adds those in, so that
+# route is the only scrape target.
+from json import dumps, loads
+from os import environ, getpid, kill, listdir, makedirs, remove, replace
+from os.path import isdir, join
+from re import compile as _compile
+from tempfile import gettempdir
+from threading import Lock
+from time import time
+
+_lock = Lock()
+_counters = {}
+_gauges = {}
+# name -> [count, sum, max]
+_summaries = {}
+# (name, labels) -> [buckets, counts per bucket + one over the last, sum]
+_histograms = {}
+
+# seconds, from a cached read to a request that timed out
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# for things counted per request, like sql statements
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+DIR = environ.get("METRICS_DIR") or join(
+    "/dev/shm" if isdir("/dev/shm") else gettempdir(), "qbytic-metrics"
+)
+FLUSH_SECONDS = 5
+_last_flush = 0
+
+
+def inc(name: str, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name: str, value):
+    _gauges[name] = value
+
+
+def observe(name: str, value: float):
+    with _lock:
+        summary = _summaries.get(name)
+        if summary is None:
+            _summaries[name] = [1, value, value]
+            return
+        summary[0] += 1
+        summary[1] += value
+        if value > summary[2]:
+            summary[2] = value
+
+
+def histogram(name: str, value: float, buckets: tuple = BUCKETS, **labels):
+    """Count `value` in the first bucket it fits, per set of `labels`"""
+    key = name, tuple(sorted(labels.items()))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [buckets, [0] * (len(buckets) + 1), 0.0]
+        counts = histogram[1]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        histogram[2] += value
+
+
+def snapshot() -> dict:
+    with _lock:
+        summaries = {
+            name: {"count": c, "sum": s, "max": m, "avg": s / c}
+            for name, (c, s, m) in _summaries.items()
+        }
+        histograms = [
+            {
+                "name": name,
+                "labels": dict(labels),
+                "buckets": list(buckets),
+                "counts": list(counts),
+                "sum": total,
+            }
+            for (name, labels), (buckets, counts, total) in _histograms.items()
+        ]
+        return {
+            "pid": getpid(),
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "summaries": summaries,
+            "histograms": histograms,
+        }
+
+
+def flush(force: bool = False):
+    """Write this worker's snapshot for `collect`, at most every FLUSH_SECONDS"""
+    global _last_flush
+    now = time()
+    if not force and now - _last_flush < FLUSH_SECONDS:
+        return
+    _last_flush = now
+    try:
+        makedirs(DIR, exist_ok=True)
+        path = join(DIR, f"{getpid()}.json")
+        with open(f"{path}.tmp", "w") as f:
+            f.write(dumps(snapshot()))
+        replace(f"{path}.tmp", path)
+    except OSError as e:
+        print(f"metrics: could not write {DIR}: {e}")
+
+
+def _alive(pid: int) -> bool:
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect() -> list:
+    """Snapshots of every live worker on this dyno"""
+    flush(force=True)
+    snapshots = []
+    try:
+        names = listdir(DIR)
+    except OSError:
+        return [snapshot()]
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        path = join(DIR, name)
+        pid = int(name[: -len(".json")])
+        if not _alive(pid):
+            try:
+                # a worker that was restarted, its numbers went with it
+                remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path) as f:
+                snapshots.append(loads(f.read()))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+_invalid = _compile(r"[^a-zA-Z0-9_]").sub
+PREFIX = "qbytic_"
+
+
+def _name(name: str) -> str:
+    return PREFIX + _invalid("_", name)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = (f'{_invalid("_", k)}="{_escape(v)}"' for k, v in sorted(labels.items()))
+    return "{" + ",".join(pairs) + "}"
+
+
+def prometheus(snapshots: list) -> str:
+    """The snapshots added up, in prometheus' text format"""
+    counters = {}
+    gauges = []
+    summaries = {}
+    histograms = {}
+    for snap in snapshots:
+        for name, value in snap["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+        for name, value in snap["gauges"].items():
+            gauges.append((name, snap["pid"], value))
+        for name, s in snap["summaries"].items():
+            total = summaries.setdefault(name, [0, 0.0, 0.0])
+            total[0] += s["count"]
+            total[1] += s["sum"]
+            total[2] = max(total[2], s["max"])
+        for h in snap.get("histograms", ()):
+            key = h["name"], tuple(sorted(h["labels"].items()))
+            total = histograms.get(key)
+            if total is None or total[0] != h["buckets"]:
+                # first one, or the buckets changed with a deploy
+                histograms[key] = [h["buckets"], list(h["counts"]), h["sum"]]
+                continue
+            total[1] = [a + b for a, b in zip(total[1], h["counts"])]
+            total[2] += h["sum"]
+
+    lines = []
+    for name, value in sorted(counters.items()):
+        metric = _name(name) + "_total"
+        lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+    seen = set()
+    for name, pid, value in sorted(gauges, key=lambda g: (g[0], g[1])):
+        metric = _name(name)
+        if metric not in seen:
+            seen.add(metric)
+            lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric}{_labels({'pid': pid})} {value}")
+    for name, (count, total, top) in sorted(summaries.items()):
+        metric = _name(name)
+        lines += [
+            f"# TYPE {metric} summary",
+            f"{metric}_count {count}",
+            f"{metric}_sum {total}",
+            f"# TYPE {metric}_max gauge",
+            f"{metric}_max {top}",
+        ]
+    seen = set()
+    for (name, labels), (buckets, counts, total) in sorted(histograms.items()):
+        metric = _name(name)
+        if metric not in seen:
+            seen.add(metric)
+            lines.append(f"# TYPE {metric} histogram")
+        labels = dict(labels)
+        cumulative = 0
+        for bound, count in zip(buckets, counts):
+            cumulative += count
+            lines.append(f"{metric}_bucket{_labels({**labels, 'le': bound})} {cumulative}")
+        cumulative += counts[-1]
+        lines.append(f"{metric}_bucket{_labels({**labels, 'le': '+Inf'})} {cumulative}")
+        lines.append(f"{metric}_count{_labels(labels)} {cumulative}")
+        lines.append(f"{metric}_sum{_labels(labels)} {total}")
+    return "\n".join(lines) + "\n"
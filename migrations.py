@@ -0,0 +1,127 @@
+"""One-off schema migrations, run them from a one-off dyno:
+
+    python migrations.py clan_membership [--drop-legacy]
+    python migrations.py lower_name_indexes
+    python migrations.py jobs
+    python migrations.py worker_metrics
+"""
+from sys import argv
+
+from sqlalchemy import text
+
+from app_init import ClanMembership, Job, TeamTable, UserTable, WorkerMetrics, db
+
+# pylint: disable=E1101
+
+# Invites, requests and members were stored twice: as ARRAY columns on
+# team_table and as {event: [clan, ...]} JSONB on user_table. Both sides are
+# copied so links that only survived on one side are kept, rows pointing at
+# clans or users that no longer exist are dropped.
+_COPY_TEAM_ARRAYS = """
+INSERT INTO clan_membership (clan, "user", kind, event, created_at)
+SELECT t.team_name, l."user", :kind, t.team_event,
+       extract(epoch from now()) + l.position * 1e-6
+FROM team_table t
+CROSS JOIN unnest(t.{column}) WITH ORDINALITY AS l("user", position)
+JOIN user_table u ON u."user" = l."user"
+ON CONFLICT DO NOTHING
+"""
+
+_COPY_USER_JSONB = """
+INSERT INTO clan_membership (clan, "user", kind, event, created_at)
+SELECT t.team_name, u."user", :kind, t.team_event,
+       extract(epoch from now()) + 1 + l.position * 1e-6
+FROM user_table u
+CROSS JOIN jsonb_each(
+    CASE WHEN jsonb_typeof(u.{column}) = 'object' THEN u.{column} ELSE '{{}}' END
+) AS e(event, clans)
+CROSS JOIN jsonb_array_elements_text(
+    CASE WHEN jsonb_typeof(e.clans) = 'array' THEN e.clans ELSE '[]' END
+) WITH ORDINALITY AS l(clan, position)
+JOIN team_table t ON t.team_name = l.clan AND t.team_event = e.event
+ON CONFLICT DO NOTHING
+"""
+
+_LEGACY_COLUMNS = {
+    "team_table": ("members", "clan_invites", "clan_requests"),
+    "user_table": ("clan_invites", "clan_requests"),
+}
+
+
+def clan_membership(drop_legacy=False):
+    ClanMembership.__table__.create(db.engine, checkfirst=True)
+    session = db.session
+    links = (
+        ("members", ClanMembership.MEMBER),
+        ("clan_invites", ClanMembership.INVITE),
+        ("clan_requests", ClanMembership.REQUEST),
+    )
+    for column, kind in links:
+        inserted = session.execute(
+            text(_COPY_TEAM_ARRAYS.format(column=column)), {"kind": kind}
+        ).rowcount
+        print(f"team_table.{column}: {inserted} rows")
+        if column == "members":
+            continue
+        inserted = session.execute(
+            text(_COPY_USER_JSONB.format(column=column)), {"kind": kind}
+        ).rowcount
+        print(f"user_table.{column}: {inserted} rows")
+
+    if drop_legacy:
+        for table, columns in _LEGACY_COLUMNS.items():
+            drops = ", ".join(f"DROP COLUMN IF EXISTS {c}" for c in columns)
+            session.execute(text(f"ALTER TABLE {table} {drops}"))
+    session.commit()
+
+
+def _create_missing_indexes(table, prefix=""):
+    # Index.create() has no checkfirst, and reflection skips expression indexes
+    existing = {
+        x[0]
+        for x in db.session.execute(
+            text("SELECT indexname FROM pg_indexes WHERE tablename = :t"),
+            {"t": table.name},
+        )
+    }
+    for index in table.indexes:
+        if index.name.startswith(prefix) and index.name not in existing:
+            index.create(db.engine)
+
+
+def lower_name_indexes(drop_legacy=False):
+    # the case-insensitive user/clan lookups can't use the primary keys
+    for table in (UserTable.__table__, TeamTable.__table__):
+        _create_missing_indexes(table, f"ix_{table.name}_lower_")
+
+
+def jobs(drop_legacy=False):
+    table = Job.__table__
+    table.create(db.engine, checkfirst=True)
+    # tables created before jobs could be deduplicated
+    db.session.execute(
+        text(
+            "ALTER TABLE job ADD COLUMN IF NOT EXISTS dedupe_key VARCHAR(100);"
+            "DROP INDEX IF EXISTS ix_job_pending_run_at"
+        )
+    )
+    db.session.commit()
+    _create_missing_indexes(table)
+
+
+def worker_metrics(drop_legacy=False):
+    WorkerMetrics.__table__.create(db.engine, checkfirst=True)
+
+
+MIGRATIONS = {
+    "clan_membership": clan_membership,
+    "lower_name_indexes": lower_name_indexes,
+    "jobs": jobs,
+    "worker_metrics": worker_metrics,
+}
+
+
+if __name__ == "__main__":
+    if len(argv) < 2 or argv[1] not in MIGRATIONS:
+        raise SystemExit(f"usage: migrations.py [{'|'.join(MIGRATIONS)}] [--drop-legacy]")
+    MIGRATIONS[argv[1]](drop_legacy="--drop-legacy" in argv)
@@ -0,0 +1,92 @@
+"""Per request SQL log: budgets, slow statements and N+1 patterns
+"""
+# db_pool's cursor events hand every statement of a request to `record`,
+# app_init.record_request calls `report` when the request is done. The
+# statements are kept grouped by their text ( SQLAlchemy sends parameters
+# separately, so the same query for another user has the same text ), with
+# a count, total and slowest time each: memory stays bounded by the number
+# of distinct statements, however many times one of them runs.
+#
+# SQL_LOG=budget ( the default ) logs only requests that break a budget or
+#     repeat a statement, safe for production
+# SQL_LOG=all also logs every other request's totals, for development
+# SQL_LOG=off records nothing
+from os import environ
+from re import compile as _compile
+
+import metrics
+
+MODE = environ.get("SQL_LOG", "budget")
+# a request is flagged past any of these
+STATEMENT_BUDGET = int(environ.get("SQL_STATEMENT_BUDGET", 25))
+TIME_BUDGET = float(environ.get("SQL_TIME_BUDGET", 0.5))
+# the same statement this often in one request looks like a loop of lookups
+REPEAT_LIMIT = int(environ.get("SQL_REPEAT_LIMIT", 5))
+SLOW_STATEMENT = float(environ.get("SQL_SLOW_STATEMENT", 0.2))
+# statements shown per flagged request, and characters of each
+_SHOW = 5
+_WIDTH = 160
+
+
+def start():
+    """A new log for a request, None when logging is off"""
+    return None if MODE == "off" else {}
+
+
+def record(log: dict, statement: str, took: float):
+    entry = log.get(statement)
+    if entry is None:
+        log[statement] = [1, took, took]
+        return
+    entry[0] += 1
+    entry[1] += took
+    if took > entry[2]:
+        entry[2] = took
+
+
+# the column list says little, the FROM and WHERE tell the queries apart
+_columns = _compile(r"^SELECT .+? FROM ").sub
+
+
+def short(statement: str) -> str:
+    statement = _columns("SELECT ... FROM ", " ".join(statement.split()), count=1)
+    if len(statement) > _WIDTH:
+        return statement[: _WIDTH - 3] + "..."
+    return statement
+
+
+def report(route: str, log: dict):
+    """Log the request if it broke a budget, or always with SQL_LOG=all"""
+    if not log:
+        return
+    count = sum(entry[0] for entry in log.values())
+    total = sum(entry[1] for entry in log.values())
+    repeated = [(s, e) for s, e in log.items() if e[0] >= REPEAT_LIMIT]
+    slow = [(s, e) for s, e in log.items() if e[2] >= SLOW_STATEMENT]
+    problems = []
+    if count > STATEMENT_BUDGET:
+        problems.append(f"{count} statements > {STATEMENT_BUDGET}")
+    if total > TIME_BUDGET:
+        problems.append(f"{total * 1e3:.0f}ms > {TIME_BUDGET * 1e3:.0f}ms")
+    if repeated:
+        problems.append(f"{len(repeated)} repeated statement(s), likely N+1")
+    if slow:
+        problems.append(f"{len(slow)} slow statement(s)")
+
+    if not problems:
+        if MODE == "all":
+            print(f"sql: {route}: {count} statements, {total * 1e3:.1f}ms")
+        return
+
+    metrics.inc("sql_requests_flagged")
+    if repeated:
+        metrics.inc("sql_n_plus_one")
+    lines = [f"sql: {route}: {count} statements, {total * 1e3:.1f}ms: {'; '.join(problems)}"]
+    # repeats first, then by time spent
+    key = lambda item: (item[1][0] >= REPEAT_LIMIT, item[1][1])
+    worst = sorted(log.items(), key=key, reverse=True)
+    for statement, (times, spent, slowest) in worst[:_SHOW]:
+        lines.append(
+            f"    {times:>4}x {spent * 1e3:8.1f}ms (max {slowest * 1e3:.1f}ms)  {short(statement)}"
+        )
+    print("\n".join(lines))
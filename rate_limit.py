@@ -0,0 +1,115 @@
+"""Per IP token buckets, shared by every worker on a dyno
+"""
+# Each client IP gets a bucket per route group, kept in shared_state as
+# (tokens, updated at). A request takes as many tokens as its view costs
+# ( COSTS, 1 by default ), they come back at `rate` per second up to
+# `burst`. A bucket left alone for burst / rate seconds is
+# full again, so that's its ttl: idle IPs expire and shared_state's fixed
+# table never grows. A check is one shared_state.update, O(1).
+from math import ceil
+from time import time
+
+import metrics
+import shared_state
+from constants import IS_HEROKU
+from util import AppException
+
+# group -> (burst, tokens per second)
+LIMITS = {
+    "default": (6, 3),
+    # every login / register / refresh runs scrypt
+    "auth": (5, 0.5),
+    # each one is a round trip to discord
+    "discord": (3, 0.2),
+}
+# view function -> group, anything else is "default"
+ROUTES = {
+    "register": "auth",
+    "user_login": "auth",
+    "refesh_token": "auth",
+    "setup_discord_auth": "discord",
+}
+# view function -> tokens it takes, roughly how many scrypt runs or
+# locking writes it does compared to a cached read
+COSTS = {
+    # a hash of the new password
+    "register": 2,
+    # a verify and a new hash for the next refresh token
+    "refesh_token": 2,
+    # may hash a new password
+    "edit_user": 2,
+    # locks the clan and up to MAX_BATCH_INVITES users
+    "add_member": 2,
+}
+# failed logins / token refreshes per account: (burst, per second), ten
+# tries and then one more every 90s. Counted per account, not per IP, so
+# guessing from many addresses runs out just the same.
+ACCOUNT_FAILURES = (10, 10 / (15 * 60))
+
+
+def client_ip(request) -> str:
+    forwarded = request.headers.get("x-forwarded-for")
+    if IS_HEROKU and forwarded:
+        # heroku's router appends the address it saw, the rest is the client's say
+        return forwarded.split(",")[-1].strip()
+    return request.remote_addr or forwarded or ""
+
+
+def take(key: str, burst: float, rate: float, cost: float = 1) -> float:
+    """Take `cost` tokens from the bucket at `key`
+
+    Returns:
+        float: 0 if they were taken, else seconds until there are enough
+    """
+    now = time()
+    wait = 0.0
+
+    def refill(current):
+        nonlocal wait
+        if current is None:
+            tokens = burst
+        else:
+            tokens = min(burst, current[0] + (now - current[1]) * rate)
+        if tokens < cost:
+            wait = (cost - tokens) / rate
+            return tokens, now
+        return tokens - cost, now
+
+    shared_state.update(key, refill, ttl=burst / rate)
+    return wait
+
+
+def check(request) -> float:
+    """Rate limit a flask request, returns 0 or seconds to wait"""
+    if request.method == "OPTIONS":
+        # a CORS preflight, the request it asks about is charged itself
+        return 0
+    endpoint = request.endpoint
+    group = ROUTES.get(endpoint, "default")
+    burst, rate = LIMITS[group]
+    wait = take(f"rl:{group}:{client_ip(request)}", burst, rate, COSTS.get(endpoint, 1))
+    if wait:
+        metrics.inc(f"rate_limited_{group}")
+    return wait
+
+
+class AccountLocked(AppException):
+    retryable = True
+
+
+def charge_account(kind: str, user: str):
+    """Take one try from `user`'s `kind` budget before checking a password
+    or refresh token, `clear_account` once it turned out right
+
+    Raises:
+        AccountLocked: the budget is used up, nothing was checked
+    """
+    burst, rate = ACCOUNT_FAILURES
+    wait = take(f"fail:{kind}:{user}", burst, rate)
+    if wait:
+        metrics.inc(f"account_locked_{kind}")
+        raise AccountLocked(f"Too many failed attempts, try again in {ceil(wait)} seconds")
+
+
+def clear_account(kind: str, user: str):
+    shared_state.delete(f"fail:{kind}:{user}")
@@ -17,6 +17,7 @@ from time import time
 from flask import make_response, send_from_directory
 
 from safe_io import open_and_read, open_and_write
+from tracing import traced
 from util import safe_mkdir, safe_remove
 
 DEFAULT_CACHE_TIMEOUT = 60
@@ -36,6 +37,7 @@ def get_file_name(key):
     return f"{key}.#cache.json"
 
 
+@traced("cache.read")
 def get_cache(key, timeout):
     fn = get_file_name(key)
     path = Path(CACHE_DIR, fn)
@@ -61,6 +63,7 @@ def get_cache(key, timeout):
 DATA_SUFFIX = ".___data"
 
 
+@traced("cache.write")
 def cache_json(key, data):
 
     fn = get_file_name(key)
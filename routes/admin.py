@@ -13,6 +13,13 @@ def admin_score(team):
     return admin.score_team(ParsedRequest(), team)
 
 
+# rate many submissions at once
+@app.route("/admin/scores/bulk/", **POST_REQUEST)
+@api_response
+def admin_bulk_score():
+    return admin.bulk_score(ParsedRequest())
+
+
 @app.route("/admin/<team>/disqualify/", **POST_REQUEST)
 @api_response
 def admin_disqualify(team):
@@ -25,6 +32,27 @@ def admin_requalify(team):
     return admin.requalify(ParsedRequest(), team)
 
 
+# change an event's config, every worker picks it up
+@app.route("/admin/events/<event>/config/", **POST_REQUEST)
+@api_response
+def admin_event_config(event):
+    return admin.update_event_config(ParsedRequest(), event)
+
+
+# fix everyone's discord roles in the background
+@app.route("/admin/discord/reconcile/", **POST_REQUEST)
+@api_response
+def admin_reconcile_roles():
+    return admin.reconcile_discord_roles(ParsedRequest())
+
+
+# create accounts from a CSV or NDJSON upload
+@app.route("/admin/users/import/", **POST_REQUEST)
+@api_response
+def admin_import_users():
+    return admin.import_users(ParsedRequest())
+
+
 # view all users
 @app.route("/admin/users/all/", strict_slashes=False)
 @api_response
@@ -37,3 +65,17 @@ def all_users_secure():
 @api_response
 def all_teams_secure():
     return admin.get_secure_team_data(ParsedRequest())
+
+
+# pool and request metrics of the worker that serves this request
+@app.route("/admin/metrics/", strict_slashes=False)
+@api_response
+def worker_metrics():
+    return admin.get_metrics(ParsedRequest())
+
+
+# every worker's metrics added up, in prometheus' text format
+@app.route("/admin/metrics/prometheus/", strict_slashes=False)
+@api_response
+def prometheus_metrics():
+    return admin.get_prometheus_metrics(ParsedRequest())
@@ -1,6 +1,6 @@
 from flask import request
 
-from api_handlers import users
+from api_handlers import teams, users
 from app_init import app
 from util import POST_REQUEST, ParsedRequest, api_response, json_response
 
@@ -40,6 +40,13 @@ def user_details(user):
     return users.get_user_details(ParsedRequest(), user)
 
 
+# all clans of a user, keyed by event
+@app.route("/users/<user>/clans/", strict_slashes=False)
+@api_response
+def user_clans(user):
+    return teams.get_user_clans(ParsedRequest(), user)
+
+
 # edit user info, only authenticated requests allowed
 @app.route("/users/<user>/edit/", **POST_REQUEST)
 @api_response
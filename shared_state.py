@@ -0,0 +1,152 @@
+"""Tiny fixed-size key/value table in shared memory
+"""
+# Every gunicorn worker on a dyno maps the same file ( in /dev/shm when it
+# exists ) so state like "this user just wrote something" or rate limit
+# buckets is seen by all of them, not just the worker that served the request.
+#
+# Each slot holds a 64 bit key hash, an expiry time and two floats. Keys hash
+# into a small window of slots, an insert takes an empty or expired slot in
+# that window or evicts the one closest to expiring. Memory use is fixed and
+# every operation touches at most PROBE slots.
+#
+# Other dynos have their own table, so whatever is stored here is per dyno.
+from fcntl import LOCK_EX, LOCK_UN, flock
+from hashlib import blake2b
+from mmap import mmap
+from os import O_CREAT, O_RDWR, close, environ, fstat, ftruncate, getpid
+from os import open as _open
+from os.path import isdir, join
+from struct import Struct
+from tempfile import gettempdir
+from threading import Lock
+from time import time
+
+_SLOT = Struct("<Qddd")  # key hash, expires at, a, b
+SLOTS = 1 << 16
+PROBE = 16
+_SIZE = SLOTS * _SLOT.size
+_MASK = SLOTS - 1
+
+PATH = environ.get("SHARED_STATE_PATH") or join(
+    "/dev/shm" if isdir("/dev/shm") else gettempdir(), "qbytic-shared-state"
+)
+
+_thread_lock = Lock()
+_fd = None
+_map = None
+_pid = None
+
+
+def _open_table():
+    # (re)open after fork: flock() locks belong to the open file, a descriptor
+    # inherited from the master would not keep the workers apart
+    global _fd, _map, _pid
+    if _map is not None:
+        _map.close()
+        close(_fd)
+    fd = _open(PATH, O_RDWR | O_CREAT, 0o600)
+    flock(fd, LOCK_EX)
+    try:
+        if fstat(fd).st_size < _SIZE:
+            ftruncate(fd, _SIZE)
+    finally:
+        flock(fd, LOCK_UN)
+    _fd, _map, _pid = fd, mmap(fd, _SIZE), getpid()
+
+
+def _hash(key: str) -> int:
+    # 0 marks an empty slot
+    return int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+
+
+class _Locked:
+    def __enter__(self):
+        _thread_lock.acquire()
+        try:
+            if _pid != getpid():
+                _open_table()
+            flock(_fd, LOCK_EX)
+        except:
+            _thread_lock.release()
+            raise
+        return _map
+
+    def __exit__(self, *args):
+        flock(_fd, LOCK_UN)
+        _thread_lock.release()
+
+
+def _find(table, h: int, now: float, for_insert: bool):
+    """Returns (offset, slot) of `h`, or when `for_insert` the offset of the
+    slot `h` should be written to and None
+    """
+    start = h & _MASK
+    victim = None
+    victim_expires = None
+    for i in range(PROBE):
+        offset = ((start + i) & _MASK) * _SLOT.size
+        slot = _SLOT.unpack_from(table, offset)
+        slot_hash, expires = slot[0], slot[1]
+        if slot_hash == h:
+            if expires > now:
+                return offset, slot
+            return offset, None
+        if not for_insert:
+            continue
+        if slot_hash == 0 or expires <= now:
+            if victim_expires is None or victim_expires > 0:
+                victim, victim_expires = offset, 0
+        elif victim_expires is None or expires < victim_expires:
+            victim, victim_expires = offset, expires
+    return victim, None
+
+
+def get(key: str):
+    """
+    Returns:
+        tuple: (a, b) or None if the key is missing or expired
+    """
+    now = time()
+    with _Locked() as table:
+        _, slot = _find(table, _hash(key), now, False)
+    return None if slot is None else slot[2:]
+
+
+def put(key: str, a: float, b: float = 0.0, ttl: float = 60):
+    h = _hash(key)
+    now = time()
+    with _Locked() as table:
+        offset, _ = _find(table, h, now, True)
+        _SLOT.pack_into(table, offset, h, now + ttl, a, b)
+
+
+def update(key: str, func, ttl: float = 60):
+    """Atomically replace the value of `key` with `func(current)`
+
+    Args:
+        key (str)
+        func (callable): gets (a, b) or None, returns the new (a, b)
+            or None to delete the key
+        ttl (float): seconds the new value stays, or a callable that gets
+            the new value and returns them
+
+    Returns:
+        the value returned by `func`
+    """
+    h = _hash(key)
+    now = time()
+    with _Locked() as table:
+        offset, slot = _find(table, h, now, True)
+        value = func(None if slot is None else slot[2:])
+        if value is None:
+            if slot is not None:
+                _SLOT.pack_into(table, offset, 0, 0, 0, 0)
+        else:
+            if callable(ttl):
+                ttl = ttl(value)
+            _SLOT.pack_into(table, offset, h, now + ttl, value[0], value[1])
+    return value
+
+
+def delete(key: str):
+    update(key, lambda current: None)
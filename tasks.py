@@ -0,0 +1,209 @@
+"""Handlers for the background jobs in jobs.py, run by worker.py
+"""
+from smtplib import SMTPRecipientsRefused
+from time import time
+
+from requests import RequestException
+from sqlalchemy import and_, bindparam
+
+import metrics
+from api_handlers.email_manager import _send
+from app_init import UserTable, db
+from constants import PARTICIPANT_ROLE_ID, ROLE_ID_DICT
+from discord_integrations import (
+    GrantRevoked,
+    RateLimited,
+    guild_members,
+    patch_member_roles,
+    refresh_token,
+    set_roles,
+)
+from jobs import Deferred, JobFailed, enqueue, handler
+from util import AppException
+
+# pylint: disable=E1101
+
+# jobs that keep themselves scheduled, worker.py queues them when it starts
+PERIODIC = ("refresh_tokens",)
+
+
+def event_roles(team_data: dict) -> list:
+    """Discord roles of the events the user has a clan in"""
+    return [
+        ROLE_ID_DICT[event]
+        for event, data in team_data.items()
+        if data and data.get("name") is not None
+    ]
+
+
+@handler("sync_roles")
+def sync_roles(payload: dict):
+    # roles come from the user's state when the job runs, not when it was
+    # queued, so a late or repeated job still sets the right roles and every
+    # change queued while it waited is covered by one PATCH
+    user_data = UserTable.query.filter_by(user=payload["user"]).first()
+    if user_data is None or not user_data.discord_id:
+        return
+    try:
+        ok = set_roles(user_data, event_roles(user_data.team_data))
+    except RateLimited as e:
+        raise Deferred(e.retry_after)
+    if not ok:
+        raise JobFailed("Discord did not accept the role update")
+
+
+@handler("send_email")
+def send_email(payload: dict):
+    # smtp errors are retried with the job's backoff, a refused address isn't
+    try:
+        _send(payload["to"], payload["subject"], payload["content"])
+    except SMTPRecipientsRefused as e:
+        print(f"send_email: {payload['to']} refused: {e.recipients}")
+
+
+# roles the site hands out, everything else on a member is left alone
+_MANAGED_ROLES = {PARTICIPANT_ROLE_ID, *ROLE_ID_DICT.values()}
+# the sweep waits for rate limits instead of failing halfway
+_RECONCILE_WAIT = 60
+
+
+@handler("reconcile_roles", lease=60 * 60)
+def reconcile_roles(payload: dict):
+    """Repair drifted roles: one pass over the guild's member list, a PATCH
+    only for linked members whose managed roles differ from their team_data
+    """
+    desired = {
+        discord_id: {PARTICIPANT_ROLE_ID, *event_roles(team_data)}
+        for discord_id, team_data in db.session.query(
+            UserTable.discord_id, UserTable.team_data
+        ).filter(UserTable.discord_id.isnot(None))
+    }
+    # don't sit in an open transaction for the whole sweep
+    db.session.rollback()
+
+    scanned = patched = failed = 0
+    for member in guild_members(max_wait=_RECONCILE_WAIT):
+        scanned += 1
+        user_id = member["user"]["id"]
+        if user_id not in desired:
+            continue
+        roles = set(member["roles"])
+        wanted = (roles - _MANAGED_ROLES) | desired[user_id]
+        if wanted == roles:
+            continue
+        if patch_member_roles(user_id, sorted(wanted), max_wait=_RECONCILE_WAIT):
+            patched += 1
+        else:
+            failed += 1
+
+    metrics.inc("reconcile_roles_patched", patched)
+    metrics.inc("reconcile_roles_failed", failed)
+    print(f"reconcile_roles: {scanned} members, {patched} patched, {failed} failed")
+
+
+# discord tokens live a week, anything expiring within this window is
+# renewed ahead of time so requests never wait on an oauth round trip
+TOKEN_REFRESH_WINDOW = 2 * 24 * 60 * 60
+TOKEN_REFRESH_EVERY = 60 * 60
+TOKEN_REFRESH_BATCH = 100
+
+_users = UserTable.__table__
+# only if the token is still the one we refreshed, a request may have
+# refreshed it in the meantime
+_save_tokens = (
+    _users.update()
+    .where(
+        and_(
+            _users.c.user == bindparam("b_user"),
+            _users.c.discord_refresh_token == bindparam("b_old"),
+        )
+    )
+    .values(
+        discord_access_token=bindparam("b_access"),
+        discord_refresh_token=bindparam("b_refresh"),
+        discord_token_expires_in=bindparam("b_expires"),
+    )
+)
+
+
+def _save_refreshed(rows: list):
+    if rows:
+        db.session.execute(_save_tokens, rows)
+        db.session.commit()
+        metrics.inc("discord_tokens_refreshed", len(rows))
+
+
+def _refresh_batch(due: list) -> tuple:
+    """Refresh `due` [(user, refresh_token), ...], returns the rows to save
+    and, if discord asked us to slow down, how long to wait
+    """
+    rows = []
+    try:
+        return _refresh_each(due, rows)
+    except BaseException:
+        # discord has already rotated these, losing them unlinks the users
+        _save_refreshed(rows)
+        raise
+
+
+def _refresh_each(due: list, rows: list) -> tuple:
+    for user, old in due:
+        try:
+            data = refresh_token(old)
+        except GrantRevoked:
+            # revoked, the user has to link discord again
+            data = {"access": None, "refresh": None, "expires": None}
+            metrics.inc("discord_tokens_revoked")
+        except RateLimited as e:
+            return rows, e.retry_after
+        except (AppException, RequestException, ValueError, KeyError):
+            # a timeout or a bad answer, this one is tried again next run
+            metrics.inc("discord_token_refresh_failed")
+            continue
+        expires = data["expires"]
+        rows.append(
+            {
+                "b_user": user,
+                "b_old": old,
+                "b_access": data["access"],
+                "b_refresh": data["refresh"] or (old if expires else None),
+                # stored as a timestamp, like UserTable.__setattr__ does
+                "b_expires": int(time() + expires) if expires else None,
+            }
+        )
+    return rows, 0
+
+
+@handler("refresh_tokens", lease=30 * 60)
+def refresh_tokens(payload: dict):
+    """Renew every discord token that expires within TOKEN_REFRESH_WINDOW,
+    a batch at a time, each batch is saved with one executemany
+    """
+    due_before = time() + TOKEN_REFRESH_WINDOW
+    last = ""
+    delay = TOKEN_REFRESH_EVERY
+    while True:
+        due = (
+            db.session.query(UserTable.user, UserTable.discord_refresh_token)
+            .filter(
+                UserTable.discord_refresh_token.isnot(None),
+                UserTable.discord_token_expires_in < due_before,
+                UserTable.user > last,
+            )
+            .order_by(UserTable.user)
+            .limit(TOKEN_REFRESH_BATCH)
+            .all()
+        )
+        # no transaction stays open while we talk to discord
+        db.session.rollback()
+        if not due:
+            break
+        rows, retry_after = _refresh_batch(due)
+        _save_refreshed(rows)
+        if retry_after:
+            # pick up where we stopped once discord lets us
+            delay = retry_after
+            break
+        last = due[-1][0]
+
+    enqueue("refresh_tokens", {}, delay=delay, dedupe_key="refresh_tokens")
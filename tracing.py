@@ -0,0 +1,182 @@
+"""Sampled per request span traces, written as JSON lines
+"""
+# `start` begins a trace for a sampled request ( or job ), `span` times a
+# step of it, nested steps become children. The active trace lives in a
+# threading.local, one request per thread, so code deep down ( decode_token,
+# a cursor event ) adds spans without anything being passed around. Outside
+# a sampled trace `span` costs an attribute lookup.
+#
+# `finish` appends the trace to TRACE_FILE as one line, once the file is
+# past TRACE_MAX_BYTES it's moved to TRACE_FILE.1 and a new one started:
+#     {"trace_id", "span_id", "parent", "name", "start", "duration", "attrs",
+#      "spans": [{"id", "parent", "name", "start", "duration", "attrs"}, ...]}
+# with times in seconds, starts relative to the trace's. The trace itself is
+# the root span, its "parent" is the span a job was queued from.
+#
+# `context` is put in job payloads by jobs.enqueue, the job's trace then
+# has the request's trace_id and hangs off the span that queued it.
+from contextlib import contextmanager
+from functools import wraps
+from json import dumps
+from os import O_APPEND, O_CREAT, O_WRONLY, close, environ, fstat, replace, stat, write
+from os import open as _open
+from os.path import join
+from random import random
+from secrets import token_hex
+from tempfile import gettempdir
+from threading import local
+from time import perf_counter, time
+
+import metrics
+
+SAMPLE_RATE = float(environ.get("TRACE_SAMPLE_RATE", 0.01))
+TRACE_FILE = environ.get("TRACE_FILE") or join(gettempdir(), "qbytic-traces.jsonl")
+TRACE_MAX_BYTES = int(environ.get("TRACE_MAX_BYTES", 50 * 1024 * 1024))
+# a request stuck in a loop of queries shouldn't grow without bound
+MAX_SPANS = 500
+
+_local = local()
+
+
+class _Trace:
+    __slots__ = ("id", "root", "name", "start", "clock", "spans", "stack", "parent")
+
+    def __init__(self, name: str, trace_id: str, parent: str):
+        self.id = trace_id or token_hex(16)
+        self.root = token_hex(8)
+        self.name = name
+        self.start = time()
+        self.clock = perf_counter()
+        self.spans = []
+        # ids of the open spans, the innermost last
+        self.stack = [self.root]
+        self.parent = parent
+
+
+def start(name: str, force: bool = False, context: dict = None):
+    """Begin a trace on this thread if it's sampled, `context` continues
+    one from another process ( always sampled, its parent was )
+    """
+    if context:
+        _local.trace = _Trace(name, context["trace_id"], context["span_id"])
+    elif force or random() < SAMPLE_RATE:
+        _local.trace = _Trace(name, None, None)
+    else:
+        _local.trace = None
+
+
+def active() -> bool:
+    return getattr(_local, "trace", None) is not None
+
+
+def context():
+    """The current trace and span, for a job queued from here, or None"""
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        return None
+    return {"trace_id": trace.id, "span_id": trace.stack[-1]}
+
+
+def record(name: str, started: float, duration: float, **attrs):
+    """Add a finished span, `started` is a perf_counter() reading"""
+    trace = getattr(_local, "trace", None)
+    if trace is None or len(trace.spans) >= MAX_SPANS:
+        return
+    trace.spans.append(
+        {
+            "id": token_hex(8),
+            "parent": trace.stack[-1],
+            "name": name,
+            "start": round(started - trace.clock, 6),
+            "duration": round(duration, 6),
+            "attrs": attrs,
+        }
+    )
+
+
+@contextmanager
+def span(name: str, **attrs):
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        yield
+        return
+    span_id = token_hex(8)
+    parent = trace.stack[-1]
+    trace.stack.append(span_id)
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        trace.stack.pop()
+        if len(trace.spans) < MAX_SPANS:
+            trace.spans.append(
+                {
+                    "id": span_id,
+                    "parent": parent,
+                    "name": name,
+                    "start": round(started - trace.clock, 6),
+                    "duration": round(perf_counter() - started, 6),
+                    "attrs": attrs,
+                }
+            )
+
+
+def traced(name: str):
+    """Decorator form of `span`"""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(_local, "trace", None) is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _rotate(fd: int):
+    written = fstat(fd)
+    if written.st_size < TRACE_MAX_BYTES:
+        return
+    # another worker may have rotated it already, don't move its new file
+    try:
+        if stat(TRACE_FILE).st_ino != written.st_ino:
+            return
+    except FileNotFoundError:
+        return
+    replace(TRACE_FILE, f"{TRACE_FILE}.1")
+
+
+def finish(**attrs):
+    """End this thread's trace and write it out, if there was one"""
+    trace = getattr(_local, "trace", None)
+    _local.trace = None
+    if trace is None:
+        return
+    line = dumps(
+        {
+            "trace_id": trace.id,
+            "span_id": trace.root,
+            "parent": trace.parent,
+            "name": trace.name,
+            "start": trace.start,
+            "duration": round(perf_counter() - trace.clock, 6),
+            "attrs": attrs,
+            "spans": trace.spans,
+        }
+    )
+    try:
+        # one write of a whole line to an O_APPEND file, workers writing at
+        # the same time don't interleave
+        fd = _open(TRACE_FILE, O_WRONLY | O_APPEND | O_CREAT, 0o600)
+        try:
+            write(fd, f"{line}\n".encode())
+            _rotate(fd)
+        finally:
+            close(fd)
+        metrics.inc("traces_written")
+    except OSError as e:
+        print(f"tracing: could not write {TRACE_FILE}: {e}")
@@ -13,6 +13,8 @@ from flask import request as _request
 from flask import Request as _Request
 from flask import Response as _Response
 
+import idempotency as _idempotency
+
 
 # wraps list() around a map call
 def map_to_list(*args) -> list:
@@ -80,24 +82,34 @@ def api_response(func):
     # this has to be done otherwise flask will perceive all view_functions as `run`
     @_wraps(func)
     def run(*args, **kwargs):
+        key = _request.headers.get("Idempotency-Key")
+        if key and _request.method == "POST":
+            # a retried POST gets the first response, see idempotency.py
+            return _idempotency.run(key, lambda: respond(args, kwargs))
+        return respond(args, kwargs)[0]
+
+    def respond(args, kwargs):
+        # (response, whether a retry may be given the same one)
         try:
             ret = func(*args, **kwargs)
             if isinstance(ret, _Response):
-                return ret
-            return json_response({"data": ret})
+                return ret, True
+            return json_response({"data": ret}), True
 
         except AppException as e:
-            return json_response({"error": f"{e}"})
+            return json_response({"error": f"{e}"}), not e.retryable
         except Exception as e:
             _print_exc()
             err = "An unknown error occured"
-            return json_response({"error": err, "tb": f"{e}"})
+            return json_response({"error": err, "tb": f"{e}"}), False
 
     return run
 
 
 class AppException(Exception):
-    pass
+    # errors that can go away by themselves, like rate limits, a retry
+    # with the same Idempotency-Key runs the handler again
+    retryable = False
 
 
 POST_REQUEST = dict(strict_slashes=False, methods=["post"])
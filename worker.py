@@ -0,0 +1,90 @@
+"""Background job runner ( see jobs.py ), the `worker` process in the Procfile
+
+    python worker.py                  run jobs until SIGTERM
+    python worker.py --retry-dead     requeue dead-lettered jobs and exit
+    python worker.py --enqueue KIND   queue a job without payload and exit,
+                                      e.g. reconcile_roles from the scheduler
+"""
+from os import environ, getpid
+from signal import SIGINT, SIGTERM, signal
+from sys import argv
+from time import sleep, time
+
+from sqlalchemy.dialects.postgresql import insert
+
+import jobs
+import metrics
+import tasks  # registers the handlers
+from app_init import WorkerMetrics, app, db
+from constants import JOB_POLL_SECONDS
+
+_running = [True]
+_last_save = [0.0]
+
+
+def _stop(signum, frame):
+    # finish the current job, heroku waits 30s before killing us
+    _running[0] = False
+
+
+def save_metrics():
+    """Store this worker's snapshot ( smtp and discord timings ) in the
+    database, at most every metrics.FLUSH_SECONDS. The web dynos export it
+    """
+    now = time()
+    if now - _last_save[0] < metrics.FLUSH_SECONDS:
+        return
+    _last_save[0] = now
+    table = WorkerMetrics.__table__
+    values = {
+        "worker": f"{environ.get('DYNO', 'worker')}:{getpid()}",
+        "snapshot": metrics.snapshot(),
+        "updated_at": now,
+    }
+    stmt = insert(table).values(**values)
+    try:
+        db.session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[table.c.worker],
+                set_={"snapshot": stmt.excluded.snapshot, "updated_at": now},
+            )
+        )
+        # workers that were restarted, their numbers went with them
+        db.session.execute(
+            table.delete().where(table.c.updated_at < now - WorkerMetrics.MAX_AGE)
+        )
+        db.session.commit()
+    except Exception as e:
+        print(f"job worker: could not save metrics: {e}")
+        db.session.rollback()
+
+
+def main():
+    signal(SIGTERM, _stop)
+    signal(SIGINT, _stop)
+    for kind in tasks.PERIODIC:
+        jobs.enqueue(kind, {}, dedupe_key=kind)
+    db.session.commit()
+    while _running[0]:
+        try:
+            ran = jobs.run_one()
+        except Exception as e:
+            # the database went away, back off and try again
+            print(f"job worker: {e}")
+            db.session.rollback()
+            ran = False
+        save_metrics()
+        if not ran:
+            sleep(JOB_POLL_SECONDS)
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        if "--retry-dead" in argv:
+            print(f"requeued {jobs.retry_dead()} jobs")
+        elif "--enqueue" in argv:
+            kind = argv[argv.index("--enqueue") + 1]
+            jobs.enqueue(kind, {}, dedupe_key=kind)
+            db.session.commit()
+        else:
+            main()